@@ -130,3 +130,762 @@ def test_hilife_case1():
     assert zns_org.ssd.group_list[0].remain_space == 0
     assert zns_org.ssd.group_list[1].remain_space == 2500
     assert zns_org.ssd.group_list[2].remain_space == 1000
+
+def test_lazy_allocation():
+    # Default geometry: 32 zones x 32768 blocks, only written blocks are allocated
+    zns_fs = ZnsFileSystem()
+    zns_fs.createFile(4096 * 3 + 100)
+
+    assert len(zns_fs.ssd.group_list[0].group_list) == 4
+    assert len(zns_fs.ssd.group_list[1].group_list) == 0
+    assert zns_fs.ssd.getFileChunk(0, 3, 0).size == 100
+    assert zns_fs.ssd.remain_space == zns_fs.ssd.max_space - 4096 * 3 - 100
+    assert zns_fs.ssd.updateRemainSpace() == zns_fs.ssd.remain_space
+
+    # Block counters are columns of the zone, blocks are views of them
+    zone = zns_fs.ssd.group_list[0]
+    assert list(zone.block_remain_space) == [0, 0, 0, 3996]
+    assert list(zone.block_live_chunks) == [1, 1, 1, 1]
+    zns_fs.deleteFile(0)
+    assert list(zone.block_stale_size) == [4096, 4096, 4096, 100]
+    assert zone.group_list[-1].stale_size == 100
+    assert zns_fs.file_table[0].chunk_list[3].logi_unit == zone.group_list[3]
+    zns_fs.ssd.verifyCounters()
+
+    zns_fs.ssd.resetZone(0)
+    assert len(zns_fs.ssd.group_list[0].group_list) == 0
+    assert zns_fs.ssd.updateRemainSpace() == zns_fs.ssd.max_space
+
+def test_write_pointer():
+    zns_fs = ZnsFileSystem(num_of_zones=3, num_of_blocks=3, block_size=100)
+    zns_fs.createFile(450)
+    zns_fs.createFileOnZone(120, 2)
+
+    assert zns_fs.ssd.first_free_zone == 1
+    assert zns_fs.ssd.group_list[1].write_pointer == 2
+    assert zns_fs.ssd.group_list[1].first_free_block == 1
+    assert zns_fs.ssd.group_list[2].first_free_block == 1
+    assert zns_fs.ssd.remain_space == 330
+    assert zns_fs.ssd.remain_space == zns_fs.ssd.updateRemainSpace()
+
+    zns_fs.deleteFile(0)
+    zns_fs.gcStaleGreedy()
+    assert zns_fs.ssd.first_free_zone == 0
+    assert zns_fs.ssd.group_list[0].write_pointer == 0
+    assert zns_fs.ssd.remain_space == zns_fs.ssd.updateRemainSpace()
+
+def test_space_counters():
+    zns_fs = ZnsFileSystem(num_of_zones=3, num_of_blocks=4, block_size=100, check_consistency=True)
+    zns_fs.setGCThreshold(0.5)
+    zns_fs.createFile(330)
+    zns_fs.createFile(250)
+    zns_fs.createFileOnZone(120, 2)
+    zns_fs.deleteFileChunks(0, 1, 3)
+    zns_fs.updateFile(1, 0, 2, 180)
+    zns_fs.deleteFile(2)
+    zns_fs.garbageCollection()
+
+    zone_list = zns_fs.ssd.group_list
+    assert zns_fs.ssd.getStaleSize() == sum(zone.getStaleSize() for zone in zone_list)
+    assert zns_fs.ssd.getStaleSize() == zns_fs.ssd.calcStaleSize()
+    assert zns_fs.ssd.remain_space == zns_fs.ssd.calcRemainSpace()
+    assert zns_fs.ssd.getUsedSize() == sum(zone.getUsedSize() for zone in zone_list)
+
+def test_zone_index():
+    zone_index = ZoneIndex([30, 0, 70, 70, 10])
+
+    assert zone_index.argMax() == 2
+    assert zone_index.findFirst(50) == 2
+    assert zone_index.findFirst(50, 3) == 3
+    assert zone_index.findFirst(80) == -1
+    zone_index.update(2, 0)
+    assert zone_index.argMax() == 3
+    assert zone_index.findFirst(20) == 0
+
+    zns_fs = ZnsFileSystem(num_of_zones=3, num_of_blocks=2, block_size=100)
+    zns_fs.createFile(250)
+    zns_fs.createFile(80)
+    zns_fs.deleteFileChunks(0, 2, 3)
+    zns_fs.deleteFile(1)
+    assert zns_fs.ssd.getMaxStaleZone() == 1
+    assert zns_fs.ssd.findFreeZone(20) == 1
+    assert zns_fs.ssd.findFreeZone(20, exclude_zone_ids=(1,)) == 2
+    assert zns_fs.ssd.findFreeZone(100, exclude_zone_ids=(2,)) == -1
+
+def test_gc_cost_benefit():
+    zns_fs = ZnsFileSystem(num_of_zones=3, num_of_blocks=4, block_size=100, gc_policy=CostBenefitPolicy())
+    zns_fs.createFile(400)
+    for i in range(5):
+        zns_fs.updateLifeTime()
+    zns_fs.createFile(400)
+    zns_fs.deleteFileChunks(0, 0, 2) # Zone 0: 200 stale, old live data
+    zns_fs.deleteFileChunks(1, 0, 3) # Zone 1: 300 stale, young live data
+
+    assert GreedyPolicy().selectVictim(zns_fs) == 1
+    assert zns_fs.gc_policy.selectVictim(zns_fs) == 0
+    zns_fs.garbageCollection()
+    assert zns_fs.gc_zone_reset_times == 1
+    assert zns_fs.ssd.group_list[0].remain_space == 400
+    assert zns_fs.ssd.group_list[2].remain_space == 200
+    assert zns_fs.file_list[0].chunk_list[0].life_time == 5
+
+def test_gc_life_time_full():
+    # No empty zone is left for the hot and cold destinations
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=2, block_size=100, gc_policy=LifeTimePolicy())
+    zns_fs.createFile(150)
+    zns_fs.createFile(150)
+    zns_fs.deleteFileChunks(0, 0, 1)
+    zns_fs.garbageCollection()
+
+    assert zns_fs.gc_zone_reset_times == 1
+    assert zns_fs.ssd.group_list[0].remain_space == 200
+    # The live chunks of both files filled zone 1
+    assert zns_fs.ssd.group_list[1].remain_space == 0
+    assert zns_fs.gc_migrate_size == 100
+
+def test_gc_life_time():
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=4, block_size=100, gc_policy=LifeTimePolicy(age_threshold=1))
+    zns_fs.createFile(200)
+    zns_fs.updateLifeTime()
+    zns_fs.updateLifeTime()
+    zns_fs.createFile(200)
+    zns_fs.deleteFileChunks(0, 1, 2)
+    zns_fs.deleteFileChunks(1, 1, 2)
+    zns_fs.garbageCollection()
+
+    # Cold chunk of File 0 and hot chunk of File 1 are moved to different zones
+    assert zns_fs.ssd.getFileChunk(1, 0, 0).inode == 0
+    assert zns_fs.ssd.getFileChunk(1, 0, 0).life_time == 2
+    assert zns_fs.ssd.getFileChunk(2, 0, 0).inode == 1
+    assert zns_fs.ssd.group_list[0].remain_space == 400
+
+def test_migrate_zone():
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=3, block_size=100, check_consistency=True)
+    zns_fs.createFile(250)
+    zns_fs.createFile(30)
+    zns_fs.createFile(100)
+    zns_fs.deleteFileChunks(0, 0, 1)
+    zns_fs.garbageCollection()
+
+    # Live chunks of Zone 0 are appended after Zone 1's last written block
+    assert zns_fs.ssd.getFileChunk(1, 1, 0).inode == 0
+    assert zns_fs.ssd.getFileChunk(1, 2, 0).inode == 0
+    assert zns_fs.ssd.getFileChunk(1, 2, 1).inode == 1
+    assert zns_fs.ssd.getFileChunk(1, 2, 2).inode == 2
+    assert zns_fs.ssd.group_list[1].group_list[0].remain_space == 20
+    assert zns_fs.gc_migrate_times == 4
+    assert zns_fs.gc_migrate_size == 200
+
+    file = zns_fs.file_list[0]
+    assert file.chunk_list[0] == zns_fs.ssd.getFileChunk(1, 1, 0)
+    assert file.chunk_list[1] == zns_fs.ssd.getFileChunk(1, 2, 0)
+    assert all(file.chunk_table.in_file[handle] for handle in file.chunk_map)
+
+def test_life_time_epoch():
+    zns_fs = ZnsFileSystem(num_of_zones=3, num_of_blocks=2, block_size=100, check_consistency=True)
+    zns_fs.createFile(150)
+    zns_fs.createFile(100)
+    zns_fs.deleteFile(1) # life time of File 0's chunks: 1
+    zns_fs.createFile(50)
+    zns_fs.updateFile(0, 1, 2, 20) # life time of File 0's chunks: 2, File 2's: 1
+
+    zone_list = zns_fs.ssd.group_list
+    assert zns_fs.file_list[0].chunk_list[0].life_time == 2
+    assert zns_fs.file_list[0].chunk_list[1].life_time == 0
+    assert zns_fs.file_list[1].chunk_list[0].life_time == 0
+    assert zone_list[0].getLifeTime() == 2
+    assert zone_list[1].getLifeTime() == 1
+    assert zns_fs.ssd.getLifeTime() == zns_fs.ssd.calcLifeTime() == 3
+
+def test_chunk_table():
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=2, block_size=100, check_consistency=True)
+    zns_fs.createFile(150)
+    zns_fs.createFile(100)
+    zns_fs.deleteFileChunks(0, 0, 1)
+    chunk_table = zns_fs.ssd.chunk_table
+
+    assert len(chunk_table) == 4
+    assert chunk_table.sumSizeByZone(2, True) == [100, 0]
+    assert chunk_table.sumSizeByZone(2, False) == [100, 50]
+    assert zns_fs.file_list[1].chunk_list[1] == zns_fs.ssd.getFileChunk(1, 0, 0)
+
+    # Chunk 0 of File 0 is erased by GC and its row is recycled
+    zns_fs.garbageCollection()
+    assert len(chunk_table.free_handles) == 3
+    assert len(chunk_table) == 3
+    assert zns_fs.file_list[0].chunk_list[0].logi_unit.zone_id == 1
+
+def test_replay_trace(tmp_path):
+    import gzip
+    from zns_replay import TraceReplayer, readTrace, writeBinaryTrace
+
+    trace_path = str(tmp_path / 'trace.csv.gz')
+    with gzip.open(trace_path, 'wt') as f:
+        f.write('# op,args\ncreate,10,20\ncreate,11,130\ncreate,12,25\ndelete,11\ngc\n'
+                'create,13,40\ngc\ncreate,14,65\nappend,10,20\nappend,99,10\n')
+    binary_path = str(tmp_path / 'trace.bin')
+    writeBinaryTrace(readTrace(trace_path), binary_path)
+    jsonl_path = str(tmp_path / 'trace.jsonl')
+    with open(jsonl_path, 'w') as f:
+        f.write('{"op": "create", "file": 1, "size": 150}\n{"op": "update", "file": 1, "beg": 0, "end": 1, "size": 30}\n')
+
+    for path in (trace_path, binary_path):
+        zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=1, block_size=100)
+        replayer = TraceReplayer(zns_fs, stats_interval=4)
+        snapshots = list(replayer.replay(readTrace(path)))
+
+        # Same result as main.py
+        assert [stats['ops'] for stats in snapshots] == [4, 8, 10]
+        assert snapshots[-1]['errors'] == 1
+        assert snapshots[-1]['error_counts'] == {'UnknownFileError': 1}
+        assert snapshots[-1]['host_write_size'] == 300
+        assert zns_fs.gc_zone_reset_times == 2
+        assert zns_fs.ssd.getFileChunk(0, 0, 0).inode == 3
+        assert zns_fs.file_list[0].size == 40
+
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=1, block_size=100)
+    stats = TraceReplayer(zns_fs).run(readTrace(jsonl_path))
+    assert stats['ops'] == 2
+    assert zns_fs.file_list[0].size == 80
+
+def test_errors_and_events():
+    import pytest
+    from zns_sim import NotEnoughSpaceError, UnknownFileError
+
+    events = []
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=1, block_size=100,
+                           event_hook=lambda event, *args: events.append((event, args)))
+    assert zns_fs.createFile(150) == 0
+    assert zns_fs.createFile(100) == NotEnoughSpaceError.code
+    assert isinstance(zns_fs.last_error, NotEnoughSpaceError)
+    assert zns_fs.appendFile(5, 10) == UnknownFileError.code
+    assert zns_fs.updateFile(0, 0, 1, 200) == NotEnoughSpaceError.code
+    assert zns_fs.error_count == 3
+    assert [event for event, args in events] == ['create', 'error', 'error', 'error']
+    assert events[0][1] == (0, 150)
+    assert str(events[2][1][0]) == 'Unknown file inode 5.'
+
+    zns_fs.setEventHook(None)
+    zns_fs.raise_errors = True
+    with pytest.raises(UnknownFileError):
+        zns_fs.deleteFile(3)
+    assert zns_fs.error_count == 4
+
+def test_benchmark():
+    from zns_bench import WORKLOADS, compareResults, runSuite
+
+    ops = list(WORKLOADS['zipf'].generate(200, 8 * 4096, 4096, seed=1))
+    assert ops == list(WORKLOADS['zipf'].generate(200, 8 * 4096, 4096, seed=1))
+    assert ops[0][0] == 'create'
+
+    suite = runSuite(['uniform', 'append'], [(4, 4, 4096)], 300, seed=1)
+    assert [result['workload'] for result in suite['results']] == ['uniform', 'append']
+    for result in suite['results']:
+        assert sum(stats['count'] for stats in result['op_stats'].values()) == 300
+        assert result['gc_count'] > 0
+        assert result['peak_memory'] > 0
+    assert [row[2] > 0 for row in compareResults(suite, suite)] == [True, True]
+
+def test_parameter_sweep(tmp_path):
+    from zns_replay import writeBinaryTrace
+    from zns_sweep import getSweepConfigs, runSweep
+
+    configs = getSweepConfigs([(4, 16, 1024), (8, 16, 1024)], [0, 0.5], ['greedy', 'life_time'], [1])
+    assert len(configs) == 8
+    rows = runSweep(configs, workload='uniform', num_ops=300, gc_free_ratio=0.2, processes=1)
+    parallel_rows = runSweep(configs, workload='uniform', num_ops=300, gc_free_ratio=0.2, processes=2)
+    for row, parallel_row in zip(rows, parallel_rows):
+        del row['elapsed'], parallel_row['elapsed']
+        assert row == parallel_row
+    # All configs replay the same trace
+    assert {row['ops'] for row in rows} == {300}
+    assert rows[0]['gc_zone_reset_times'] > 0
+
+    trace_path = str(tmp_path / 'trace.bin')
+    writeBinaryTrace([('create', (1, 20)), ('create', (2, 130)), ('create', (3, 25)), ('delete', (2,)), ('gc', ())],
+                     trace_path)
+    rows = runSweep(getSweepConfigs([(2, 1, 100)], [0], ['greedy', 'life_time'], [0]), trace=trace_path, processes=1)
+    assert [row['gc_zone_reset_times'] for row in rows] == [1, 1]
+    assert [row['gc_migrate_size'] for row in rows] == [20, 20]
+
+def test_snapshot(tmp_path):
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=2, block_size=100)
+    zns_fs.createFile(20)
+    zns_fs.createFile(130)
+    zns_fs.createFile(25)
+    zns_fs.deleteFile(1)
+    zns_fs.garbageCollection()
+    zns_fs.createFile(40)
+    zns_fs.updateFile(0, 0, 1, 30)
+    path = str(tmp_path / 'warm.snap')
+    zns_fs.saveSnapshot(path)
+
+    restored = ZnsFileSystem.loadSnapshot(path, check_consistency=True)
+    assert restored.gc_zone_reset_times == zns_fs.gc_zone_reset_times == 1
+    assert restored.inode == 4
+    # File 1 was reclaimed by GC
+    assert sorted(restored.file_table) == [0, 2, 3]
+    assert restored.ssd.remain_space == zns_fs.ssd.remain_space
+    assert restored.ssd.getLifeTime() == zns_fs.ssd.getLifeTime()
+    for zns in (zns_fs, restored):
+        assert [[chunk.size for chunk in file.chunk_list] for file in zns.file_table.values()] == [[30], [25], [40]]
+
+    # The restored file system continues exactly like the original one
+    for zns in (zns_fs, restored):
+        zns.createFile(150)
+        zns.deleteFile(2)
+        zns.garbageCollection()
+    chunk_lists = ([], [])
+    zns_fs.ssd.getFileChunkList(chunk_lists[0])
+    restored.ssd.getFileChunkList(chunk_lists[1])
+    assert [(chunk.inode, chunk.size, chunk.life_time) for chunk in chunk_lists[0]] \
+        == [(chunk.inode, chunk.size, chunk.life_time) for chunk in chunk_lists[1]]
+    assert restored.ssd.stale_size == zns_fs.ssd.stale_size
+    assert restored.gc_migrate_size == zns_fs.gc_migrate_size
+
+def test_file_reclamation(tmp_path):
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=1, block_size=100, check_consistency=True)
+    zns_fs.createFile(20)
+    zns_fs.createFile(130)
+    zns_fs.createFile(25)
+    zns_fs.deleteFile(1)
+    zns_fs.garbageCollection()
+    # Chunk 1 of file 1 is still stored in zone 1
+    assert zns_fs.file_table[1].status == 'deleted'
+    assert [file.inode for file in zns_fs.getLiveFiles()] == [0, 2]
+
+    path = str(tmp_path / 'deleted.snap')
+    zns_fs.saveSnapshot(path)
+    restored = ZnsFileSystem.loadSnapshot(path)
+    for zns in (zns_fs, restored):
+        assert zns.file_table[1].status == 'deleted'
+        zns.garbageCollection()
+        assert sorted(zns.file_table) == [0, 2]
+        assert len(zns.ssd.chunk_table) == 2
+        assert zns.deleteFile(1) == -2
+
+    # Churn runs in a bounded inode table and ChunkTable
+    for i in range(200):
+        inode = zns_fs.createFile(60)
+        zns_fs.deleteFile(inode)
+        zns_fs.garbageCollection()
+    assert len(zns_fs.file_table) <= 3
+    assert len(zns_fs.ssd.chunk_table.inode) <= 6
+
+def test_chunk_map():
+    import pytest
+    from zns_sim import ChunkMoveError
+
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=2, block_size=100, check_consistency=True)
+    zns_fs.createFile(150)
+    zns_fs.createFile(40)
+    zns_fs.deleteFileChunks(0, 0, 1)
+    zns_fs.appendFile(0, 30)
+    # Chunk ids are not reused after a delete
+    file = zns_fs.file_table[0]
+    assert [(chunk.id, chunk.size) for chunk in file.chunk_list] == [(1, 50), (2, 10), (3, 20)]
+    assert file.chunk_map.findOffset(55) == 1
+    assert file.chunk_map.findChunk(3) == file.chunk_map[-1]
+
+    # Bytes 40 to 59 are in chunks 1 and 2, which are rewritten in place of the old ones
+    assert zns_fs.overwriteFile(0, 40, 20) == 60
+    assert file.size == 80
+    assert [(chunk.id, chunk.size, chunk.logi_unit.zone_id) for chunk in file.chunk_list] \
+        == [(1, 50, 1), (2, 10, 1), (3, 20, 1)]
+    assert zns_fs.ssd.getStaleSize() == 160
+    # An overwrite of no chunk doesn't tick the life time clock
+    now = zns_fs.ssd.clock.now
+    assert zns_fs.overwriteFile(0, 200, 20) == 0
+    assert zns_fs.overwriteFile(0, 10, 0) == 0
+    assert zns_fs.ssd.clock.now == now
+
+    # An overwrite stops at the first chunk it can't rewrite: chunk 1 of File 2 doesn't
+    # fit at the write pointer of Zone 1. The rewritten chunk 0 is accounted for.
+    events = []
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=2, block_size=100, check_consistency=True,
+                           raise_errors=True, event_hook=lambda event, *args: events.append(event))
+    for size in (80, 50, 110):
+        zns_fs.createFile(size)
+    zns_fs.overwriteFile(1, 0, 50)
+    host_write_size = zns_fs.host_write_size
+    now = zns_fs.ssd.clock.now
+    with pytest.raises(ChunkMoveError):
+        zns_fs.overwriteFile(2, 0, 110)
+    assert zns_fs.host_write_size == host_write_size + 70
+    assert zns_fs.ssd.clock.now == now + 1
+    assert events[-1] == 'error' and events.count('overwrite') == 1
+    assert [chunk.life_time for chunk in zns_fs.file_table[2].chunk_list] == [0, 2]
+    zns_fs.raise_errors = False
+    assert zns_fs.overwriteFile(2, 70, 40) == ChunkMoveError.code
+
+    # Range deletes across segments
+    chunk_table = ChunkTable()
+    chunk_map = ChunkMap(chunk_table)
+    handles = [chunk_table.newChunk(0, i, 10, 0) for i in range(1000)]
+    for handle in handles:
+        chunk_map.append(handle)
+    assert list(chunk_map.delete(100, 700)) == handles[100:700]
+    assert list(chunk_map) == handles[:100] + handles[700:]
+    assert chunk_map[150] == handles[750]
+    assert chunk_map.findOffset(1005) == 100
+    assert chunk_map.findChunk(500) is None
+
+def test_zns_array():
+    from zns_array import LeastUsedPlacement, StripePlacement, ZnsArray
+    from zns_sim import UnknownFileError
+
+    with ZnsArray(num_of_devices=2, num_of_zones=2, num_of_blocks=1, block_size=100,
+                  placement=StripePlacement(50), workers=2, check_consistency=True) as zns_array:
+        # Stripes [0, 50) and [100, 130) on device 0, [50, 100) on device 1
+        inode = zns_array.createFile(130)
+        assert [device.ssd.remain_space for device in zns_array.devices] == [120, 150]
+        assert zns_array.overwriteFile(inode, 60, 10) == 50
+        assert [device.ssd.getStaleSize() for device in zns_array.devices] == [0, 50]
+
+        zns_array.placement = LeastUsedPlacement()
+        assert zns_array.file_table[zns_array.createFile(40)].first_device == 0
+        zns_array.deleteFile(inode)
+        assert zns_array.garbageCollection() == [1, 1]
+        stats = zns_array.getStats()
+        assert stats['gc_zone_reset_times'] == 2
+        assert stats['host_write_size'] == 220
+        assert [device['remain_space'] for device in stats['devices']] == [160, 200]
+        assert zns_array.createFile(1000) == -1
+        assert isinstance(zns_array.last_error, NotEnoughSpaceError)
+    assert zns_array.devices[1].ssd.id == 1
+
+    # With automatic GC, a device collects garbage before its share is rejected
+    zns_array = ZnsArray(num_of_devices=1, num_of_zones=2, num_of_blocks=1, block_size=100, auto_gc_step=10)
+    zns_array.createFile(100)
+    zns_array.createFile(50)
+    zns_array.deleteFile(0)
+    assert zns_array.createFile(80) == 2
+
+    # The share written on device 0 is removed when device 1 fails
+    zns_array = ZnsArray(num_of_devices=2, num_of_zones=2, num_of_blocks=1, block_size=100,
+                         placement=StripePlacement(50), check_consistency=True)
+    file = zns_array.file_table[zns_array.createFile(100)]
+    zns_array.devices[1].deleteFile(file.device_inodes[1])
+    assert zns_array.appendFile(file.inode, 100) == UnknownFileError.code
+    assert file.size == 100
+    assert zns_array.devices[0].file_table[file.device_inodes[0]].size == 50
+
+def test_zone_states():
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=1, block_size=100, check_consistency=True,
+                           max_open_zones=1, max_active_zones=2)
+    ssd = zns_fs.ssd
+    zns_fs.createFile(50)
+    # Opening Zone 1 closes Zone 0, and no third zone can be activated
+    zns_fs.createFileOnZone(20, 1)
+    assert [ssd.getZoneState(zone_id) for zone_id in range(4)] == ['closed', 'open', 'empty', 'empty']
+    assert zns_fs.createFileOnZone(10, 2) == -1
+
+    # Writes go to the open zone, then to the reopened closed zone and to a new one
+    zns_fs.createFile(70)
+    assert zns_fs.finishZone(1)
+    assert ssd.remain_space == 250
+    zns_fs.createFile(60)
+    assert [ssd.getZoneState(zone_id) for zone_id in range(4)] == ['full', 'full', 'open', 'empty']
+    assert ssd.peekZone(2).remain_space == 90
+
+    # The live 70 bytes of Zone 1 move to the open Zone 2
+    zns_fs.deleteFile(1)
+    zns_fs.garbageCollection()
+    assert [ssd.getZoneState(zone_id) for zone_id in range(4)] == ['full', 'empty', 'open', 'empty']
+    assert ssd.remain_space == 20 + 100 + 100
+
+    # A reset SSD has no open or active zone left to count against the limits
+    ssd.resetState()
+    assert [ssd.getZoneState(zone_id) for zone_id in range(4)] == ['empty'] * 4
+    assert not ssd.open_zones and not ssd.active_zones
+    zns_fs.createFile(30)
+    zns_fs.createFileOnZone(20, 3)
+    assert [ssd.getZoneState(zone_id) for zone_id in range(4)] == ['closed', 'empty', 'empty', 'open']
+    assert zns_fs.createFileOnZone(10, 1) == -1
+
+def test_gc_active_zone_limit():
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=2, block_size=100, check_consistency=True,
+                           max_open_zones=2, max_active_zones=2)
+    ssd = zns_fs.ssd
+    zns_fs.createFile(200)
+    zns_fs.createFile(150)
+    zns_fs.createFileOnZone(120, 2)
+    zns_fs.deleteFileChunks(0, 0, 1)
+
+    # The live chunk of Zone 0 fits neither in the active Zones 1 and 2 nor in Zone 3,
+    # which can't be activated, so Zone 0 is not reset
+    assert zns_fs.garbageCollection() == 0
+    assert zns_fs.gc_zone_reset_times == 0
+    assert [ssd.peekZone(zone_id).remain_space for zone_id in range(4)] == [0, 50, 80, 200]
+    assert ssd.getFileChunk(0, 1, 0).inode == 0
+
+def test_gc_move_failure():
+    import pytest
+    from zns_sim import ChunkMoveError
+
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=2, block_size=100, check_consistency=True,
+                           max_open_zones=2, max_active_zones=2, raise_errors=True, auto_gc_step=100)
+    zns_fs.createFile(200)
+    zns_fs.createFile(150)
+    zns_fs.createFileOnZone(120, 2)
+    zns_fs.deleteFileChunks(0, 0, 1)
+
+    # The automatic GC can't move the live chunk of Zone 0, which is not an error of
+    # the host write that triggered it
+    assert zns_fs.createFile(10) == 3
+    assert 3 in zns_fs.file_table and zns_fs.inode == 4
+    assert zns_fs.gc_move_failures == 1 and zns_fs.error_count == 0
+    assert zns_fs.gc_victim == -1 and zns_fs.gc_zone_reset_times == 0
+
+    # A move asked by the host still fails with an error
+    with pytest.raises(ChunkMoveError):
+        zns_fs.moveOneChunk(zns_fs.file_table[3].chunk_list[0], 1, 0)
+    assert zns_fs.error_count == 1
+
+def test_auto_gc():
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=1, block_size=100, check_consistency=True, auto_gc_step=10)
+    zns_fs.setGCThreshold(0.5)
+    ssd = zns_fs.ssd
+    for i in range(10):
+        zns_fs.createFile(20)
+    for inode in range(3):
+        zns_fs.deleteFile(inode)
+
+    # Above the threshold, each write migrates one live chunk of Zone 0
+    zns_fs.createFile(20)
+    assert zns_fs.gc_victim == 0 and ssd.getZoneState(0) == 'full'
+    assert zns_fs.gc_migrate_size == 20 and zns_fs.gc_zone_reset_times == 0
+    zns_fs.appendFile(10, 10)
+    assert zns_fs.gc_victim == -1 and ssd.getZoneState(0) == 'empty'
+    assert zns_fs.gc_migrate_size == 40 and zns_fs.gc_zone_reset_times == 1
+
+    # A write that doesn't fit runs foreground GC instead of failing
+    for inode in range(5, 9):
+        zns_fs.deleteFile(inode)
+    assert ssd.remain_space == 230
+    assert zns_fs.createFile(250) == 11
+    assert zns_fs.error_count == 0 and zns_fs.gc_zone_reset_times == 2
+    assert [chunk.size for chunk in zns_fs.file_table[11].chunk_list] == [80, 100, 30, 40]
+
+def test_auto_gc_failure():
+    import pytest
+
+    # Fails the move of the second live chunk of the victim
+    class FailingPolicy(GreedyPolicy):
+        moves = 0
+
+        def selectDestination(self, fs, file_chunk, victim_zone_id):
+            self.moves += 1
+            if self.moves == 2:
+                raise RuntimeError('move failed')
+            return super().selectDestination(fs, file_chunk, victim_zone_id)
+
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=1, block_size=100, check_consistency=True,
+                           raise_errors=True, gc_policy=FailingPolicy(), auto_gc_step=10)
+    for size in (40, 30, 30):
+        zns_fs.createFile(size)
+    zns_fs.deleteFile(0)
+    zns_fs.createFile(10)
+    assert zns_fs.gc_victim == 0 and zns_fs.gc_migrate_size == 30
+
+    # The victim is given up, not reset by the next step, and File 2 is kept
+    with pytest.raises(RuntimeError):
+        zns_fs.createFile(10)
+    assert zns_fs.gc_victim == -1 and zns_fs.file_table[2].chunk_list[0].logi_unit.zone_id == 0
+    zns_fs.garbageCollection()
+    assert zns_fs.gc_zone_reset_times == 1 and zns_fs.gc_migrate_size == 60
+    assert zns_fs.file_table[2].chunk_list[0].logi_unit is not None
+
+def test_batch_operations():
+    import pytest
+
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=4, block_size=100, check_consistency=True)
+    batch_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=4, block_size=100, check_consistency=True)
+    sizes = [250, 30, 420, 80]
+    assert batch_fs.createFiles(array('q', sizes)) == [zns_fs.createFile(size) for size in sizes] == [0, 1, 2, 3]
+    assert batch_fs.appendFiles([1, 5, 3], [40, 10, 900]) == [zns_fs.appendFile(1, 40), zns_fs.appendFile(5, 10),
+                                                             zns_fs.appendFile(3, 900)] == [40, -2, -1]
+    assert batch_fs.deleteFiles([0, 2, 7]) == [zns_fs.deleteFile(0), zns_fs.deleteFile(2), zns_fs.deleteFile(7)]
+    assert batch_fs.error_count == 3
+    # An empty file is reclaimed by its first delete, File 0 stays until GC
+    assert batch_fs.createFiles([0]) == [zns_fs.createFile(0)] == [4]
+    assert batch_fs.deleteFiles([4, 4, 0]) == [zns_fs.deleteFile(4), zns_fs.deleteFile(4), zns_fs.deleteFile(0)] \
+        == [None, -2, None]
+
+    # Items of different lengths are rejected before any of them is applied
+    with pytest.raises(ValueError):
+        batch_fs.appendFiles([1, 3, 1], [10, 20])
+    assert batch_fs.file_table[1].size == 70
+
+    for fs in (zns_fs, batch_fs):
+        fs.garbageCollection()
+    assert batch_fs.ssd.clock.now == zns_fs.ssd.clock.now == 4
+    assert batch_fs.ssd.remain_space == zns_fs.ssd.remain_space
+    assert batch_fs.ssd.getLifeTime() == zns_fs.ssd.getLifeTime()
+    assert [[(chunk.id, chunk.size, chunk.logi_unit.zone_id) for chunk in file.chunk_list]
+            for file in batch_fs.getLiveFiles()] == \
+           [[(chunk.id, chunk.size, chunk.logi_unit.zone_id) for chunk in file.chunk_list]
+            for file in zns_fs.getLiveFiles()]
+
+def test_timing(tmp_path):
+    from zns_timing import TimingModel
+
+    # File 1 is programmed on both zones at once, unless one zone works at a time
+    for parallel_zones, latency in ((0, 100), (1, 150)):
+        zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=1, block_size=100)
+        timing = TimingModel(zns_fs, program_time=1, read_time=0.5, reset_time=10, parallel_zones=parallel_zones)
+        zns_fs.createFile(150)
+        assert timing.getOperationStats()['create'] == (1, latency, latency)
+
+    # GC reads the 20 bytes of zone 0, programs them on zone 1 once read and resets
+    # zone 0 meanwhile
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=1, block_size=100)
+    timing = TimingModel(zns_fs, program_time=1, read_time=0.5, reset_time=10, interval=2)
+    zns_fs.createFile(20)
+    zns_fs.createFile(130)
+    zns_fs.deleteFile(1)
+    zns_fs.garbageCollection()
+    timing.flush()
+    assert timing.getOperationStats()['gc'] == (1, 30, 30)
+    assert timing.zone_free == [120, 130]
+    assert timing.getSeries('time') == [100, 130]
+    assert timing.getSeries('throughput') == [1.5, 0]
+
+    # Whole run percentiles are rounded up to their 1% bucket
+    stats = timing.getStats()
+    assert stats['latency_max'] == 80
+    assert 20 <= stats['latency_p50'] <= 20 * 1.01
+    assert stats['latency_p999'] == 80
+
+    path = str(tmp_path / 'timing.csv')
+    timing.writeCsv(path)
+    with open(path) as f:
+        assert len(f.read().splitlines()) == 3
+
+    timing.detach()
+    zns_fs.createFile(5)
+    assert timing.op_count == 4
+
+    # The host doesn't wait for the background GC step, but the next write to the
+    # zone it copies into does
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=1, block_size=100, auto_gc_step=10)
+    zns_fs.setGCThreshold(0.5)
+    timing = TimingModel(zns_fs, program_time=1, read_time=0.5, reset_time=10)
+    for i in range(10):
+        zns_fs.createFile(20)
+    for i in range(3):
+        zns_fs.deleteFile(i)
+    assert timing.now == 200
+    zns_fs.createFile(20)
+    assert timing.now == 220 and zns_fs.gc_migrate_size == 20
+    assert timing.zone_free[2] == 240
+    zns_fs.createFile(20)
+    assert timing.now == 260
+
+def test_fork():
+    zns_fs = ZnsFileSystem(num_of_zones=3, num_of_blocks=1, block_size=100)
+    zns_fs.createFile(20)
+    zns_fs.createFile(130)
+    zns_fs.createFile(25)
+    zns_fs.deleteFile(1)
+
+    fork = zns_fs.fork(gc_policy=LifeTimePolicy())
+    fork.garbageCollection()
+    fork.createFile(60)
+    # Only the zones used by the fork are copied
+    assert [zone.chunk_table is fork.ssd.chunk_table for zone in list.__iter__(fork.ssd.group_list)] \
+        == [True, False, True]
+
+    # The original file system is not affected by the fork
+    assert zns_fs.gc_zone_reset_times == 0
+    assert zns_fs.ssd.getStaleSize() == 130
+    assert len(zns_fs.file_list) == 3
+    assert [chunk.size for chunk in zns_fs.file_list[0].chunk_list] == [20]
+    assert zns_fs.file_list[0].chunk_list[0].logi_unit.zone_id == 0
+
+    assert fork.gc_zone_reset_times == 1
+    assert fork.ssd.getStaleSize() == 50
+    assert fork.file_list[0].chunk_list[0].logi_unit.zone_id == 2
+    assert fork.file_list[3].chunk_list[0].logi_unit.zone_id == 0
+    assert [file.inode for file in fork.file_list] == [0, 1, 2, 3]
+
+    # Both branches go on independently
+    zns_fs.garbageCollection()
+    assert zns_fs.file_list[0].chunk_list[0].logi_unit.zone_id == 1
+    assert fork.file_list[0].chunk_list[0].logi_unit.zone_id == 2
+    zns_fs.ssd.verifyCounters()
+    fork.ssd.verifyCounters()
+
+def test_metrics(tmp_path):
+    from zns_metrics import MetricsRecorder
+
+    zns_fs = ZnsFileSystem(num_of_zones=2, num_of_blocks=1, block_size=100)
+    recorder = MetricsRecorder(zns_fs, interval=2, capacity=3, num_of_bins=4)
+    zns_fs.createFile(20)
+    zns_fs.createFile(130)
+    zns_fs.createFile(25)
+    zns_fs.deleteFile(1)
+    zns_fs.garbageCollection()
+    zns_fs.createFile(40)
+    zns_fs.updateFile(0, 0, 1, 10)
+    recorder.flush()
+
+    # 4 samples, the first one was overwritten
+    assert recorder.num_of_samples == 4 and len(recorder) == 3
+    assert recorder.getSeries('ops') == [4, 6, 7]
+    assert recorder.getSeries('host_write_size') == [25, 40, 10]
+    assert recorder.getSeries('gc_write_size') == [0, 20, 0]
+    assert recorder.getSeries('zone_resets') == [0, 1, 0]
+    assert recorder.getSeries('total_write_amplification')[-1] == (zns_fs.host_write_size + 20) / zns_fs.host_write_size
+    assert zns_fs.host_write_size == 225
+    # Zone 0 is half full, zone 1 is 95% full with 70% stale data
+    assert recorder.getHistogram(recorder.occupancy_histogram)[-1] == [0, 0, 1, 1]
+    assert recorder.getHistogram(recorder.stale_histogram)[-1] == [1, 0, 1, 0]
+    assert recorder.getOperationStats()['create'][0] == 4
+    # updateFile() is measured as one operation
+    assert 'append' not in recorder.getOperationStats()
+
+    path = str(tmp_path / 'metrics.csv')
+    recorder.writeCsv(path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 4 and lines[0].startswith('ops,elapsed,host_write_size')
+
+    recorder.detach()
+    zns_fs.createFile(5)
+    assert recorder.op_count == 7
+
+def test_zone_stats():
+    import zns_sim
+
+    zns_fs = ZnsFileSystem(num_of_zones=4, num_of_blocks=2, block_size=100, gc_policy=CostBenefitPolicy())
+    for size in (150, 60, 120, 90, 80):
+        zns_fs.createFile(size)
+    zns_fs.updateLifeTime()
+    zns_fs.deleteFile(0)
+    zns_fs.deleteFileChunks(2, 1, 2)
+    zns_fs.updateLifeTime()
+
+    ssd = zns_fs.ssd
+    zone_stats = ssd.getZoneStats()
+    assert list(zone_stats.remain_space) == [zone.remain_space for zone in ssd.group_list]
+    assert list(zone_stats.stale_size) == [zone.stale_size for zone in ssd.group_list] == [150, 30, 0, 0]
+    assert list(zone_stats.live_chunks) == [zone.live_chunks for zone in ssd.group_list]
+    assert list(zone_stats.birth_sum) == [zone.birth_sum for zone in ssd.group_list]
+
+    # Vectorized ratios and victim selection give the same results as the loops
+    expected_ratio = []
+    for zone_id in range(ssd.num_of_zones):
+        ssd.updateZoneLifeTimeRatio(zone_id)
+        expected_ratio.append(ssd.zone_life_time_ratio[zone_id])
+    ssd.zone_life_time_ratio = [0] * ssd.num_of_zones
+    ssd.updateZoneLifeTimeRatio()
+    assert ssd.zone_life_time_ratio == expected_ratio
+
+    victim = CostBenefitPolicy().selectVictim(zns_fs)
+    numpy = zns_sim.numpy
+    zns_sim.numpy = None
+    try:
+        assert CostBenefitPolicy().selectVictim(zns_fs) == victim == 0
+    finally:
+        zns_sim.numpy = numpy
@@ -0,0 +1,257 @@
+# Array of ZNS SSDs for the ZNS File System simulator
+#
+# A ZnsArray spans several devices, each one simulated by its own ZnsFileSystem,
+# with its own SSD, ChunkTable and GC policy. A placement policy puts the files of
+# the array on the devices, whole or striped over all of them (RAID-0). The devices
+# share no state, so their GC and statistics can run on a thread pool:
+#   zns_array = ZnsArray(num_of_devices=4, num_of_zones=32, num_of_blocks=256,
+#                        placement=StripePlacement(65536), workers=4)
+#   inode = zns_array.createFile(1 << 20)
+#   zns_array.garbageCollection()
+#   print(zns_array.getStats())
+
+import concurrent.futures
+import copy
+
+from zns_sim import NotEnoughSpaceError, UnknownFileError, ZnsError, ZnsFileSystem, printEvent
+
+
+# Whole files on one device, the devices in turn
+class RoundRobinPlacement:
+    stripe_size = 0
+
+    def selectDevice(self, zns_array, inode, size):
+        return inode % len(zns_array.devices)
+
+
+# Whole files on the device with the most remain space
+class LeastUsedPlacement:
+    stripe_size = 0
+
+    def selectDevice(self, zns_array, inode, size):
+        devices = zns_array.devices
+        return max(range(len(devices)), key=lambda device_id: devices[device_id].ssd.remain_space)
+
+
+# Files striped over all devices in stripes of stripe_size bytes. The first stripe
+# of each file goes to the devices in turn, so small files are spread as well.
+class StripePlacement(RoundRobinPlacement):
+    def __init__(self, stripe_size=65536):
+        self.stripe_size = stripe_size
+
+
+class ArrayFile:
+    # A file of the array has one part, a file of the device, on every device it uses
+    def __init__(self, inode, first_device, stripe_size):
+        self.inode = inode
+        self.size = 0
+        self.first_device = first_device
+        self.stripe_size = stripe_size
+        self.device_inodes = {} # device id -> inode of the part on the device
+
+
+class ZnsArray:
+    # placement is RoundRobinPlacement by default. workers is the number of threads
+    # running the devices' GC and statistics, None runs them one after the other.
+    # Under the GIL the threads interleave, they only run in parallel on a
+    # free-threaded Python. The other kwargs are passed to the ZnsFileSystem of every
+    # device, each one getting a copy of gc_policy.
+    def __init__(self, num_of_devices=2, num_of_zones=32, num_of_blocks=32768, block_size=4096, placement=None,
+                 workers=None, verbose=False, gc_policy=None, event_hook=None, raise_errors=False, **kwargs):
+        self.devices = [ZnsFileSystem(num_of_zones, num_of_blocks, block_size, verbose=verbose,
+                                      gc_policy=copy.deepcopy(gc_policy), event_hook=event_hook,
+                                      raise_errors=raise_errors, device_id=device_id, **kwargs)
+                        for device_id in range(num_of_devices)]
+        self.placement = placement if placement is not None else RoundRobinPlacement()
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers) if workers else None
+        self.event_hook = event_hook if event_hook is not None or not verbose else printEvent
+        self.raise_errors = raise_errors
+        self.error_count = 0
+        self.last_error = None
+        self.inode = 0
+        self.file_table = {}
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Call function on every device, on the thread pool if there is one
+    def mapDevices(self, function):
+        if self.executor is None:
+            return [function(device) for device in self.devices]
+        return list(self.executor.map(function, self.devices))
+
+    # Split the byte range of the file into (device_id, offset in the part, size)
+    def getDeviceRanges(self, file, offset, size):
+        if not file.stripe_size:
+            if size > 0:
+                yield file.first_device, offset, size
+            return
+        num_of_devices = len(self.devices)
+        stripe_size = file.stripe_size
+        end = offset + size
+        while offset < end:
+            stripe, stripe_offset = divmod(offset, stripe_size)
+            length = min(stripe_size - stripe_offset, end - offset)
+            yield ((file.first_device + stripe) % num_of_devices,
+                   stripe // num_of_devices * stripe_size + stripe_offset, length)
+            offset += length
+
+    def getRemainSpace(self):
+        return sum(device.ssd.remain_space for device in self.devices)
+
+    def createFile(self, size):
+        inode = self.inode
+        file = ArrayFile(inode, self.placement.selectDevice(self, inode, size), self.placement.stripe_size)
+        ret = self.writeFile(file, size)
+        if ret < 0:
+            self.deleteParts(file)
+            return ret
+        self.file_table[inode] = file
+        self.inode += 1
+        return inode
+
+    def appendFile(self, inode, data_size):
+        file = self.file_table.get(inode)
+        if file is None:
+            return self.fail(UnknownFileError(inode))
+        return self.writeFile(file, data_size)
+
+    # Append data_size bytes to the file, after checking that every device has room
+    # for its share. Devices with automatic GC run their foreground GC first, like
+    # for their own writes. If a device fails to write its share, the shares already
+    # written on the other devices are removed.
+    def writeFile(self, file, data_size):
+        shares = {}
+        for device_id, offset, length in self.getDeviceRanges(file, file.size, data_size):
+            shares[device_id] = shares.get(device_id, 0) + length
+        for device_id, share in shares.items():
+            device = self.devices[device_id]
+            if device.auto_gc_step and share > device.ssd.remain_space:
+                device.collectForeground(share)
+            if share > device.ssd.remain_space:
+                return self.fail(NotEnoughSpaceError(data_size, self.getRemainSpace()))
+        written = [] # (device_id, number of chunks of its part before the write, -1 for a new part)
+        for device_id, share in shares.items():
+            device = self.devices[device_id]
+            try:
+                ret = self.writePart(file, device_id, share, written)
+            except ZnsError:
+                self.removeShares(file, written)
+                raise
+            if ret < 0:
+                self.removeShares(file, written)
+                return self.failOnDevice(device, ret)
+        file.size += data_size
+        return data_size
+
+    def writePart(self, file, device_id, share, written):
+        device = self.devices[device_id]
+        device_inode = file.device_inodes.get(device_id)
+        if device_inode is None:
+            ret = device.createFile(share)
+            if ret >= 0:
+                file.device_inodes[device_id] = ret
+                written.append((device_id, -1))
+            return ret
+        num_of_chunks = len(device.file_table[device_inode].chunk_map)
+        ret = device.appendFile(device_inode, share)
+        if ret >= 0:
+            written.append((device_id, num_of_chunks))
+        return ret
+
+    def removeShares(self, file, written):
+        for device_id, num_of_chunks in written:
+            device = self.devices[device_id]
+            device_inode = file.device_inodes[device_id]
+            if num_of_chunks == -1:
+                device.deleteFile(device_inode)
+                del file.device_inodes[device_id]
+            else:
+                device.deleteFileChunks(device_inode, num_of_chunks, len(device.file_table[device_inode].chunk_map))
+
+    # Overwrite size bytes of the file from the logical byte offset, see
+    # ZnsFileSystem.overwriteFile(). Returns the number of bytes written.
+    def overwriteFile(self, inode, offset, size):
+        file = self.file_table.get(inode)
+        if file is None:
+            return self.fail(UnknownFileError(inode))
+        data_written = 0
+        for device_id, device_offset, length in self.getDeviceRanges(file, offset, min(size, file.size - offset)):
+            device = self.devices[device_id]
+            ret = device.overwriteFile(file.device_inodes[device_id], device_offset, length)
+            if ret < 0:
+                return self.failOnDevice(device, ret)
+            data_written += ret
+        return data_written
+
+    def deleteFile(self, inode):
+        file = self.file_table.pop(inode, None)
+        if file is None:
+            return self.fail(UnknownFileError(inode))
+        self.deleteParts(file)
+
+    def deleteParts(self, file):
+        for device_id, device_inode in file.device_inodes.items():
+            self.devices[device_id].deleteFile(device_inode)
+
+    # Record a failed operation and return its legacy code, or raise it
+    def fail(self, error):
+        self.error_count += 1
+        self.last_error = error
+        if self.event_hook is not None:
+            self.event_hook('error', error)
+        if self.raise_errors:
+            raise error
+        return error.code
+
+    # The device already reported (or raised) its error
+    def failOnDevice(self, device, code):
+        self.error_count += 1
+        self.last_error = device.last_error
+        return code
+
+    # One GC run on every device, returns their results
+    def garbageCollection(self):
+        return self.mapDevices(ZnsFileSystem.garbageCollection)
+
+    def setGCThreshold(self, threshold):
+        for device in self.devices:
+            device.setGCThreshold(threshold)
+
+    @staticmethod
+    def getDeviceStats(device):
+        ssd = device.ssd
+        return {
+            'host_write_size': device.host_write_size,
+            'gc_migrate_times': device.gc_migrate_times,
+            'gc_migrate_size': device.gc_migrate_size,
+            'gc_zone_reset_times': device.gc_zone_reset_times,
+            'gc_move_failures': device.gc_move_failures,
+            'remain_space': ssd.remain_space,
+            'stale_size': ssd.getStaleSize(),
+            'life_time': ssd.getLifeTime(),
+        }
+
+    # Stats of the array and, in 'devices', of every device. Write amplification is
+    # the bytes written by the hosts and GC over the bytes written by the hosts.
+    def getStats(self):
+        device_stats = self.mapDevices(self.getDeviceStats)
+        stats = {name: sum(stats[name] for stats in device_stats) for name in device_stats[0]}
+        host_write_size = stats['host_write_size']
+        stats['write_amplification'] = (host_write_size + stats['gc_migrate_size']) / host_write_size \
+            if host_write_size else 0
+        stats['files'] = len(self.file_table)
+        stats['devices'] = device_stats
+        return stats
+
+    def printSSD(self):
+        for device in self.devices:
+            device.printSSD()
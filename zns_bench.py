@@ -0,0 +1,229 @@
+# Benchmark suite for the ZNS File System simulator
+#
+# Synthetic workloads are generated as trace operations (see zns_replay.py) and
+# replayed on SSDs of different geometries. Each run reports the throughput, the
+# time spent per operation and in GC, and the peak memory. Results are saved to
+# JSON so that two revisions can be compared:
+#   python zns_bench.py --output before.json
+#   python zns_bench.py --output after.json --compare before.json
+
+import argparse
+import json
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from zns_replay import TraceReplayer
+from zns_sim import ZnsFileSystem
+
+# (num_of_zones, num_of_blocks, block_size)
+GEOMETRIES = ((8, 64, 4096), (32, 256, 4096), (64, 1024, 4096))
+
+
+# Workload generator yielding trace ops. op_weights is a list of (op, weight),
+# target files are chosen uniformly, or Zipfian (rank ** -zipf_skew) when skewed.
+# Files are deleted whenever the live data exceeds fill_ratio of the capacity.
+class Workload:
+    def __init__(self, name, op_weights, zipf_skew=0, max_file_size=16, fill_ratio=0.8):
+        self.name = name
+        self.ops = [op for op, weight in op_weights]
+        self.op_weights = [weight for op, weight in op_weights]
+        self.zipf_skew = zipf_skew
+        self.max_file_size = max_file_size # in blocks
+        self.fill_ratio = fill_ratio
+
+    def chooseFile(self, rng, live_files, zipf_weights):
+        if not self.zipf_skew:
+            return rng.choice(live_files)
+        # The newest files are the hottest
+        while len(zipf_weights) < len(live_files):
+            zipf_weights.append(zipf_weights[-1] + (len(zipf_weights) + 1) ** -self.zipf_skew)
+        rank = rng.choices(range(len(live_files)), cum_weights=zipf_weights[:len(live_files)])[0]
+        return live_files[-1 - rank]
+
+    def generate(self, num_ops, capacity, block_size, seed=0):
+        rng = random.Random(seed)
+        live_files = []
+        file_sizes = {}
+        live_size = 0
+        next_file = 0
+        zipf_weights = [1.0]
+        for _ in range(num_ops):
+            op = rng.choices(self.ops, self.op_weights)[0]
+            if not live_files or op == 'create' and live_size > self.fill_ratio * capacity:
+                op = 'create' if not live_files else 'delete'
+            if op == 'create':
+                size = rng.randint(1, self.max_file_size * block_size)
+                live_files.append(next_file)
+                file_sizes[next_file] = size
+                live_size += size
+                yield 'create', (next_file, size)
+                next_file += 1
+                continue
+
+            file = self.chooseFile(rng, live_files, zipf_weights)
+            if op == 'delete':
+                live_files.remove(file)
+                live_size -= file_sizes.pop(file)
+                yield 'delete', (file,)
+            elif op == 'append':
+                size = rng.randint(1, block_size)
+                file_sizes[file] += size
+                live_size += size
+                yield 'append', (file, size)
+            elif op == 'update':
+                # Overwrite the first chunk with new data of the same scale
+                size = rng.randint(1, block_size)
+                yield 'update', (file, 0, 1, size)
+
+
+WORKLOADS = {
+    'uniform': Workload('uniform', [('create', 3), ('append', 2), ('update', 3), ('delete', 2)]),
+    'zipf': Workload('zipf', [('create', 15), ('update', 70), ('delete', 15)], zipf_skew=1.2),
+    'append': Workload('append', [('create', 2), ('append', 7), ('delete', 1)]),
+    'delete': Workload('delete', [('create', 4), ('update', 1), ('delete', 5)]),
+}
+
+
+def getRevision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Replay one workload on one geometry. GC runs whenever the free space drops
+# below gc_free_ratio. trace_memory enables tracemalloc to report the peak
+# memory, which slows down the run, so timings are only comparable between
+# runs with the same setting.
+def runBenchmark(workload, num_of_zones, num_of_blocks, block_size, num_ops, seed=0,
+                 gc_free_ratio=0.2, trace_memory=True):
+    if isinstance(workload, str):
+        workload = WORKLOADS[workload]
+    if trace_memory:
+        tracemalloc.start()
+    zns_fs = ZnsFileSystem(num_of_zones=num_of_zones, num_of_blocks=num_of_blocks, block_size=block_size)
+    replayer = TraceReplayer(zns_fs)
+    ssd = zns_fs.ssd
+    gc_space = gc_free_ratio * ssd.max_space
+    op_stats = {}
+    gc_count = 0
+    gc_time = 0.0
+    perf_counter = time.perf_counter
+
+    begin = perf_counter()
+    for op, args in workload.generate(num_ops, ssd.max_space, block_size, seed):
+        op_begin = perf_counter()
+        error = replayer.applyOp(op, args)
+        op_time = perf_counter() - op_begin
+        stats = op_stats.get(op)
+        if stats is None:
+            stats = op_stats[op] = {'count': 0, 'errors': 0, 'seconds': 0.0}
+        stats['count'] += 1
+        stats['seconds'] += op_time
+        if error is not None:
+            stats['errors'] += 1
+        if ssd.remain_space < gc_space:
+            gc_begin = perf_counter()
+            zns_fs.garbageCollection()
+            gc_time += perf_counter() - gc_begin
+            gc_count += 1
+    elapsed = perf_counter() - begin
+
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    for stats in op_stats.values():
+        stats['ops_per_sec'] = stats['count'] / stats['seconds'] if stats['seconds'] else 0
+    host_write_size = replayer.host_write_size
+    return {
+        'workload': workload.name,
+        'geometry': [num_of_zones, num_of_blocks, block_size],
+        'ops': num_ops,
+        'seed': seed,
+        'elapsed': elapsed,
+        'ops_per_sec': num_ops / elapsed if elapsed else 0,
+        'op_stats': op_stats,
+        'gc_count': gc_count,
+        'gc_time': gc_time,
+        'gc_zone_reset_times': zns_fs.gc_zone_reset_times,
+        'write_amplification': (host_write_size + zns_fs.gc_migrate_size) / host_write_size if host_write_size else 0,
+        'chunks': len(ssd.chunk_table),
+        'peak_memory': peak_memory,
+        'trace_memory': trace_memory,
+    }
+
+
+def runSuite(workloads, geometries, num_ops, seed=0, gc_free_ratio=0.2, trace_memory=True):
+    results = []
+    for name in workloads:
+        for num_of_zones, num_of_blocks, block_size in geometries:
+            results.append(runBenchmark(name, num_of_zones, num_of_blocks, block_size, num_ops,
+                                        seed, gc_free_ratio, trace_memory))
+    return {'revision': getRevision(), 'results': results}
+
+
+def getResultKey(result):
+    return (result['workload'], tuple(result['geometry']), result['ops'], result['seed'], result['trace_memory'])
+
+
+# Speedup of new over old (> 1 is faster) for the runs found in both, with the same settings
+def compareResults(old, new):
+    old_results = {getResultKey(result): result for result in old['results']}
+    rows = []
+    for result in new['results']:
+        old_result = old_results.get(getResultKey(result))
+        if old_result is None or not old_result['ops_per_sec']:
+            continue
+        rows.append((result['workload'], result['geometry'], result['ops_per_sec'] / old_result['ops_per_sec']))
+    return rows
+
+
+def printResult(result):
+    memory = '-' if result['peak_memory'] is None else '{:.1f} MiB'.format(result['peak_memory'] / 2**20)
+    print('{:8} {:>16} {:>10.0f} ops/s  gc {:6.3f}s ({} runs)  WA {:.2f}  peak {}'.format(
+        result['workload'], 'x'.join(str(n) for n in result['geometry']), result['ops_per_sec'],
+        result['gc_time'], result['gc_count'], result['write_amplification'], memory))
+
+
+def parseGeometry(text):
+    geometry = tuple(int(n) for n in text.split('x'))
+    if len(geometry) != 3:
+        raise argparse.ArgumentTypeError('geometry must be ZONESxBLOCKSxBLOCK_SIZE, got {}'.format(text))
+    return geometry
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the ZNS simulator')
+    parser.add_argument('--workloads', nargs='+', choices=sorted(WORKLOADS), default=sorted(WORKLOADS))
+    parser.add_argument('--geometries', nargs='+', type=parseGeometry, default=GEOMETRIES,
+                        help='ZONESxBLOCKSxBLOCK_SIZE, e.g. 32x256x4096')
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--gc-free-ratio', type=float, default=0.2)
+    parser.add_argument('--no-memory', action='store_true', help='do not trace the peak memory')
+    parser.add_argument('--output', help='save the results to this JSON file')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare with')
+    args = parser.parse_args(argv)
+
+    suite = runSuite(args.workloads, args.geometries, args.ops, args.seed, args.gc_free_ratio, not args.no_memory)
+    for result in suite['results']:
+        printResult(result)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(suite, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        print('Speedup over {}:'.format(old.get('revision')))
+        for workload, geometry, speedup in compareResults(old, suite):
+            print('{:8} {:>16} {:6.2f}x'.format(workload, 'x'.join(str(n) for n in geometry), speedup))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,191 @@
+# Time-series metrics of the ZNS File System simulator
+#
+# A MetricsRecorder attached to a ZnsFileSystem is told the wall-clock cost of every
+# operation, and samples the simulator counters every `interval` operations into
+# preallocated ring buffers, which keep the last `capacity` samples:
+#   recorder = MetricsRecorder(zns_fs, interval=1000)
+#   ... run the workload ...
+#   recorder.flush()
+#   recorder.writeCsv('metrics.csv')
+
+import csv
+import time
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# host_write_size, gc_write_size and zone_resets are the amounts of the sample's
+# interval, write_amplification is the interval one and total_write_amplification
+# the one since the start of the simulation. Latencies are in seconds.
+SERIES = ('ops', 'elapsed', 'host_write_size', 'gc_write_size', 'write_amplification',
+          'total_write_amplification', 'zone_resets', 'remain_space', 'stale_size',
+          'op_latency_mean', 'op_latency_max')
+
+
+# Latency stats of the operations since the start, shared with the TimingModel
+class OperationStats:
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        # op -> [count, total seconds, max seconds]
+        self.ops = {}
+
+    def add(self, op, seconds):
+        stats = self.ops.get(op)
+        if stats is None:
+            stats = self.ops[op] = [0, 0.0, 0.0]
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds > stats[2]:
+            stats[2] = seconds
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def getMean(self):
+        return self.total / self.count if self.count else 0
+
+    # (count, mean, max) in seconds of each operation
+    def getStats(self):
+        return {op: (count, total / count, max_time) for op, (count, total, max_time) in self.ops.items()}
+
+
+class MetricsRecorder:
+    # num_of_bins: number of bins of the per-zone histograms, of the used space
+    # (occupancy) and of the stale space, both relative to the zone size
+    def __init__(self, zns_fs, interval=1000, capacity=4096, num_of_bins=10):
+        self.zns_fs = zns_fs
+        self.interval = interval
+        self.capacity = capacity
+        self.num_of_bins = num_of_bins
+        self.series = {name: array('d', bytes(8 * capacity)) for name in SERIES}
+        self.occupancy_histogram = array('q', bytes(8 * capacity * num_of_bins))
+        self.stale_histogram = array('q', bytes(8 * capacity * num_of_bins))
+        self.num_of_samples = 0
+        self.in_operation = False
+        self.op_stats = OperationStats()
+        self.begin = time.perf_counter()
+        self.resetInterval()
+        zns_fs.metrics = self
+
+    def detach(self):
+        if self.zns_fs.metrics is self:
+            self.zns_fs.metrics = None
+
+    def resetInterval(self):
+        zns_fs = self.zns_fs
+        self.interval_ops = 0
+        self.interval_latency = 0.0
+        self.interval_latency_max = 0.0
+        self.last_host_write_size = zns_fs.host_write_size
+        self.last_gc_write_size = zns_fs.gc_migrate_size
+        self.last_zone_resets = zns_fs.gc_zone_reset_times
+
+    @property
+    def op_count(self):
+        return self.op_stats.count
+
+    # Called by ZnsFileSystem after every operation
+    def recordOperation(self, op, seconds):
+        self.op_stats.add(op, seconds)
+        self.interval_ops += 1
+        self.interval_latency += seconds
+        if seconds > self.interval_latency_max:
+            self.interval_latency_max = seconds
+        if self.interval_ops >= self.interval:
+            self.sample()
+
+    # Take a sample of the current interval, the oldest sample is overwritten once
+    # the buffers are full
+    def sample(self):
+        zns_fs = self.zns_fs
+        ssd = zns_fs.ssd
+        host_write_size = zns_fs.host_write_size - self.last_host_write_size
+        gc_write_size = zns_fs.gc_migrate_size - self.last_gc_write_size
+        values = {
+            'ops': self.op_count,
+            'elapsed': time.perf_counter() - self.begin,
+            'host_write_size': host_write_size,
+            'gc_write_size': gc_write_size,
+            'write_amplification': (host_write_size + gc_write_size) / host_write_size if host_write_size else 0,
+            'total_write_amplification': (zns_fs.host_write_size + zns_fs.gc_migrate_size) / zns_fs.host_write_size
+                                         if zns_fs.host_write_size else 0,
+            'zone_resets': zns_fs.gc_zone_reset_times - self.last_zone_resets,
+            'remain_space': ssd.remain_space,
+            'stale_size': ssd.stale_size,
+            'op_latency_mean': self.interval_latency / self.interval_ops if self.interval_ops else 0,
+            'op_latency_max': self.interval_latency_max,
+        }
+        i = self.num_of_samples % self.capacity
+        for name, value in values.items():
+            self.series[name][i] = value
+
+        num_of_bins = self.num_of_bins
+        base = i * num_of_bins
+        for bin_id in range(base, base + num_of_bins):
+            self.occupancy_histogram[bin_id] = 0
+            self.stale_histogram[bin_id] = 0
+        for zone_id in range(ssd.num_of_zones):
+            zone = ssd.peekZone(zone_id)
+            # A full zone falls into the last bin
+            used_bin = (zone.max_space - zone.remain_space) * num_of_bins // zone.max_space
+            stale_bin = zone.stale_size * num_of_bins // zone.max_space
+            self.occupancy_histogram[base + min(used_bin, num_of_bins - 1)] += 1
+            self.stale_histogram[base + min(stale_bin, num_of_bins - 1)] += 1
+        self.num_of_samples += 1
+        self.resetInterval()
+
+    # Sample the last, partial interval if it has operations
+    def flush(self):
+        if self.interval_ops:
+            self.sample()
+
+    def __len__(self):
+        return min(self.num_of_samples, self.capacity)
+
+    # Ring buffer positions of the kept samples, oldest first
+    def getSampleIds(self):
+        if self.num_of_samples <= self.capacity:
+            return range(self.num_of_samples)
+        first = self.num_of_samples % self.capacity
+        return [(first + i) % self.capacity for i in range(self.capacity)]
+
+    def getSeries(self, name):
+        values = self.series[name]
+        return [values[i] for i in self.getSampleIds()]
+
+    def getHistogram(self, histogram):
+        num_of_bins = self.num_of_bins
+        return [list(histogram[i * num_of_bins : (i + 1) * num_of_bins]) for i in self.getSampleIds()]
+
+    # Wall-clock latency stats of each operation: (count, mean, max) in seconds
+    def getOperationStats(self):
+        return self.op_stats.getStats()
+
+    def writeCsv(self, path):
+        occupancy = self.getHistogram(self.occupancy_histogram)
+        stale = self.getHistogram(self.stale_histogram)
+        columns = [self.getSeries(name) for name in SERIES]
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(SERIES) + ['occupancy_{}'.format(i) for i in range(self.num_of_bins)]
+                            + ['stale_{}'.format(i) for i in range(self.num_of_bins)])
+            for i in range(len(self)):
+                writer.writerow([column[i] for column in columns] + occupancy[i] + stale[i])
+
+    # Dict of 1-D arrays, one per series, and (samples x bins) arrays for the histograms
+    def toNumpy(self):
+        if numpy is None:
+            raise ImportError('toNumpy() requires numpy')
+        sample_ids = numpy.asarray(self.getSampleIds(), dtype=numpy.int64)
+        result = {name: numpy.frombuffer(self.series[name], dtype=numpy.float64)[sample_ids] for name in SERIES}
+        for name, histogram in (('occupancy_histogram', self.occupancy_histogram),
+                                ('stale_histogram', self.stale_histogram)):
+            values = numpy.frombuffer(histogram, dtype=numpy.int64).reshape(self.capacity, self.num_of_bins)
+            result[name] = values[sample_ids]
+        return result
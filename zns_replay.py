@@ -0,0 +1,284 @@
+# Trace-driven workload replay for the ZNS File System simulator
+#
+# A trace is a stream of operations. Each operation is a tuple (op, args), where
+# args refer to files by the trace's own file ids:
+#   create         file, size
+#   create_on_zone file, size, zone_id
+#   append         file, size
+#   delete         file
+#   delete_chunks  file, beg_id, end_id
+#   update         file, beg_id, end_id, size
+#   overwrite      file, offset, size
+#   gc
+# Traces are read lazily from CSV (one operation per line, e.g. "update,3,0,2,4096"),
+# JSON lines (e.g. {"op": "append", "file": 3, "size": 4096}) or binary files,
+# optionally gzip-compressed, so that replay runs in bounded memory.
+
+import argparse
+import csv
+import gzip
+import json
+import struct
+import sys
+
+from zns_metrics import MetricsRecorder
+from zns_sim import UnknownFileError, ZnsError, ZnsFileSystem
+from zns_timing import TimingModel
+
+OPS = ('create', 'create_on_zone', 'append', 'delete', 'delete_chunks', 'update', 'gc', 'overwrite')
+OP_ARGS = {
+    'create': ('file', 'size'),
+    'create_on_zone': ('file', 'size', 'zone'),
+    'append': ('file', 'size'),
+    'delete': ('file',),
+    'delete_chunks': ('file', 'beg', 'end'),
+    'update': ('file', 'beg', 'end', 'size'),
+    'gc': (),
+    'overwrite': ('file', 'offset', 'size'),
+}
+
+# Binary trace: magic, then fixed size records of an op code and 4 arguments
+BINARY_MAGIC = b'ZNSTRC01'
+BINARY_RECORD = struct.Struct('<B4q')
+BINARY_BATCH = 4096
+
+
+def openTraceFile(path, mode='rb'):
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def getTraceFormat(path):
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith('.jsonl') or name.endswith('.json'):
+        return 'jsonl'
+    if name.endswith('.bin'):
+        return 'binary'
+    raise ValueError('Unknown trace format: {}'.format(path))
+
+
+def parseOp(op, args):
+    if op not in OP_ARGS:
+        raise ValueError('Unknown trace operation: {}'.format(op))
+    if len(args) != len(OP_ARGS[op]):
+        raise ValueError('Operation {} takes {} arguments, got {}'.format(op, len(OP_ARGS[op]), len(args)))
+    return op, tuple(int(arg) for arg in args)
+
+
+def readCsvTrace(path):
+    with openTraceFile(path, 'rt') as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith('#'):
+                continue
+            yield parseOp(row[0].strip(), row[1:])
+
+
+def readJsonlTrace(path):
+    with openTraceFile(path, 'rt') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            op = record['op']
+            yield parseOp(op, [record[name] for name in OP_ARGS.get(op, ())])
+
+
+def readBinaryTrace(path):
+    with openTraceFile(path, 'rb') as f:
+        if f.read(len(BINARY_MAGIC)) != BINARY_MAGIC:
+            raise ValueError('Not a binary trace: {}'.format(path))
+        while True:
+            data = f.read(BINARY_RECORD.size * BINARY_BATCH)
+            if not data:
+                break
+            if len(data) % BINARY_RECORD.size:
+                raise ValueError('Truncated binary trace: {}'.format(path))
+            for record in BINARY_RECORD.iter_unpack(data):
+                op = OPS[record[0]]
+                yield op, record[1 : 1 + len(OP_ARGS[op])]
+
+
+def readTrace(path, trace_format=None):
+    trace_format = trace_format or getTraceFormat(path)
+    if trace_format == 'csv':
+        return readCsvTrace(path)
+    if trace_format == 'jsonl':
+        return readJsonlTrace(path)
+    if trace_format == 'binary':
+        return readBinaryTrace(path)
+    raise ValueError('Unknown trace format: {}'.format(trace_format))
+
+
+def writeBinaryTrace(ops, path):
+    op_codes = {op: i for i, op in enumerate(OPS)}
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wb') as f:
+        f.write(BINARY_MAGIC)
+        for op, args in ops:
+            args = tuple(args) + (0,) * (4 - len(args))
+            f.write(BINARY_RECORD.pack(op_codes[op], *args))
+
+
+class TraceReplayer:
+    # Replays a stream of trace operations on a ZnsFileSystem.
+    # gc_interval: run garbageCollection() every gc_interval operations (0: never)
+    # gc_free_ratio: run garbageCollection() whenever the free space ratio of the SSD
+    #   drops below this value (None: never)
+    # stats_interval: take a stats snapshot every stats_interval operations (0: only at the end)
+    def __init__(self, zns_fs, gc_interval=0, gc_free_ratio=None, stats_interval=0):
+        self.zns_fs = zns_fs
+        self.gc_interval = gc_interval
+        self.gc_free_ratio = gc_free_ratio
+        self.stats_interval = stats_interval
+        self.inode_map = {} # trace file id -> inode of the live file
+        self.op_count = 0
+        self.error_count = 0
+        self.error_counts = {} # ZnsError class name -> count
+        self.host_write_size = 0
+
+    def getStats(self):
+        zns_fs = self.zns_fs
+        data_written = self.host_write_size + zns_fs.gc_migrate_size
+        return {
+            'ops': self.op_count,
+            'errors': self.error_count,
+            'error_counts': dict(self.error_counts),
+            'host_write_size': self.host_write_size,
+            'gc_migrate_times': zns_fs.gc_migrate_times,
+            'gc_migrate_size': zns_fs.gc_migrate_size,
+            'gc_zone_reset_times': zns_fs.gc_zone_reset_times,
+            'gc_move_failures': zns_fs.gc_move_failures,
+            'write_amplification': data_written / self.host_write_size if self.host_write_size else 0,
+            'remain_space': zns_fs.ssd.remain_space,
+            'stale_size': zns_fs.ssd.getStaleSize(),
+            'live_files': len(self.inode_map),
+        }
+
+    # Apply one operation, return the ZnsError of a failed operation or None
+    def applyOp(self, op, args):
+        zns_fs = self.zns_fs
+        try:
+            if op == 'gc':
+                zns_fs.garbageCollection()
+                return None
+            if op == 'create' or op == 'create_on_zone':
+                if op == 'create':
+                    inode = zns_fs.createFile(args[1])
+                else:
+                    inode = zns_fs.createFileOnZone(args[1], args[2])
+                if inode < 0:
+                    return zns_fs.last_error
+                self.inode_map[args[0]] = inode
+                self.host_write_size += args[1]
+                return None
+
+            inode = self.inode_map.get(args[0])
+            if inode is None:
+                return UnknownFileError(args[0])
+            if op == 'append':
+                if zns_fs.appendFile(inode, args[1]) < 0:
+                    return zns_fs.last_error
+                self.host_write_size += args[1]
+            elif op == 'delete':
+                zns_fs.deleteFile(inode)
+                del self.inode_map[args[0]]
+            elif op == 'delete_chunks':
+                zns_fs.deleteFileChunks(inode, args[1], args[2])
+            elif op == 'update':
+                if zns_fs.updateFile(inode, args[1], args[2], args[3]) < 0:
+                    return zns_fs.last_error
+                self.host_write_size += args[3]
+            elif op == 'overwrite':
+                data_written = zns_fs.overwriteFile(inode, args[1], args[2])
+                if data_written < 0:
+                    return zns_fs.last_error
+                self.host_write_size += data_written
+        except ZnsError as error:
+            return error
+        return None
+
+    # Generator replaying ops and yielding a stats snapshot every stats_interval
+    # operations, and once more at the end
+    def replay(self, ops):
+        zns_fs = self.zns_fs
+        ssd = zns_fs.ssd
+        for op, args in ops:
+            error = self.applyOp(op, args)
+            if error is not None:
+                self.error_count += 1
+                kind = type(error).__name__
+                self.error_counts[kind] = self.error_counts.get(kind, 0) + 1
+            self.op_count += 1
+            if self.gc_interval and self.op_count % self.gc_interval == 0:
+                zns_fs.garbageCollection()
+            elif self.gc_free_ratio is not None and ssd.remain_space < self.gc_free_ratio * ssd.max_space:
+                zns_fs.garbageCollection()
+            if self.stats_interval and self.op_count % self.stats_interval == 0:
+                yield self.getStats()
+        if not self.stats_interval or self.op_count % self.stats_interval:
+            yield self.getStats()
+
+    # Replay all ops and return the final stats snapshot
+    def run(self, ops, on_snapshot=None):
+        stats = None
+        for stats in self.replay(ops):
+            if on_snapshot is not None:
+                on_snapshot(stats)
+        return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay a workload trace on the ZNS simulator')
+    parser.add_argument('trace', help='trace file (.csv, .jsonl or .bin, optionally .gz)')
+    parser.add_argument('--format', choices=('csv', 'jsonl', 'binary'), help='trace format, by default from the file name')
+    parser.add_argument('--zones', type=int, default=32)
+    parser.add_argument('--blocks', type=int, default=32768)
+    parser.add_argument('--block-size', type=int, default=4096)
+    parser.add_argument('--max-open-zones', type=int, default=0, help='open zone limit, 0 is unlimited')
+    parser.add_argument('--max-active-zones', type=int, default=0, help='active zone limit, 0 is unlimited')
+    parser.add_argument('--gc-threshold', type=float, default=0)
+    parser.add_argument('--gc-interval', type=int, default=0)
+    parser.add_argument('--gc-free-ratio', type=float, default=None)
+    parser.add_argument('--auto-gc-step', type=int, default=0,
+                        help='bytes migrated by the automatic GC per write above the GC threshold, 0 is off')
+    parser.add_argument('--stats-interval', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help='print every operation and error')
+    parser.add_argument('--metrics', help='save time-series metrics to this CSV file')
+    parser.add_argument('--metrics-interval', type=int, default=1000)
+    parser.add_argument('--metrics-capacity', type=int, default=100000)
+    parser.add_argument('--timing', help='simulate the device time, save its throughput and latencies to this CSV file')
+    parser.add_argument('--timing-interval', type=int, default=1000)
+    parser.add_argument('--program-time', type=float, default=1e-8, help='seconds per byte programmed')
+    parser.add_argument('--read-time', type=float, default=2.5e-9, help='seconds per byte read by GC')
+    parser.add_argument('--reset-time', type=float, default=2e-3, help='seconds per zone reset')
+    parser.add_argument('--parallel-zones', type=int, default=0, help='zones working at once, 0 is all')
+    args = parser.parse_args(argv)
+
+    zns_fs = ZnsFileSystem(num_of_zones=args.zones, num_of_blocks=args.blocks, block_size=args.block_size,
+                           verbose=args.verbose, max_open_zones=args.max_open_zones,
+                           max_active_zones=args.max_active_zones, auto_gc_step=args.auto_gc_step)
+    zns_fs.setGCThreshold(args.gc_threshold)
+    if args.metrics:
+        metrics = MetricsRecorder(zns_fs, args.metrics_interval, args.metrics_capacity)
+    if args.timing:
+        timing = TimingModel(zns_fs, args.program_time, args.read_time, args.reset_time, args.parallel_zones,
+                             args.timing_interval)
+    replayer = TraceReplayer(zns_fs, args.gc_interval, args.gc_free_ratio, args.stats_interval)
+    for stats in replayer.replay(readTrace(args.trace, args.format)):
+        print(json.dumps(stats))
+    if args.metrics:
+        metrics.flush()
+        metrics.writeCsv(args.metrics)
+    if args.timing:
+        timing.flush()
+        timing.writeCsv(args.timing)
+        print(json.dumps(timing.getStats()))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,56 +1,768 @@
 # Simple Zone Namespace SSD & File System simulator
 
+import bisect
+import copy
+import functools
+import mmap
+import struct
+import sys
+import time
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# Errors of ZnsFileSystem operations. The message is only formatted when the
+# error is printed, and code is the legacy return value of the failed operation.
+class ZnsError(Exception):
+    code = -1
+
+class NotEnoughSpaceError(ZnsError):
+    code = -1
+
+    def __init__(self, size, remain_space):
+        super().__init__(size, remain_space)
+        self.size = size
+        self.remain_space = remain_space
+
+    def __str__(self):
+        return 'Not enough space in SSD. Size: {}, Remain: {}'.format(self.size, self.remain_space)
+
+class PartialWriteError(ZnsError):
+    code = -2
+
+    def __init__(self, data_written, size):
+        super().__init__(data_written, size)
+        self.data_written = data_written
+        self.size = size
+
+    def __str__(self):
+        return 'Cannot write all data! {} / {}'.format(self.data_written, self.size)
+
+class UnknownFileError(ZnsError):
+    code = -2
+
+    def __init__(self, inode):
+        super().__init__(inode)
+        self.inode = inode
+
+    def __str__(self):
+        return 'Unknown file inode {}.'.format(self.inode)
+
+class ChunkMoveError(ZnsError):
+    code = -1
+
+    def __init__(self, inode, chunk_id, size, src_zone_id, dst_zone_id):
+        super().__init__(inode, chunk_id, size, src_zone_id, dst_zone_id)
+        self.inode = inode
+        self.chunk_id = chunk_id
+        self.size = size
+        self.src_zone_id = src_zone_id
+        self.dst_zone_id = dst_zone_id
+
+    def __str__(self):
+        return 'Cannot move chunk(id:{}, size:{}) from Zone {} to Zone {}'.format(
+            self.chunk_id, self.size, self.src_zone_id, self.dst_zone_id)
+
+
+# Event hook printing the messages of the verbose mode
+def printEvent(event, *args):
+    if event == 'error':
+        print('Error! {}'.format(args[0]))
+    elif event == 'create':
+        print("File {} (size: {}) is created.".format(*args))
+    elif event == 'create_on_zone':
+        print("File {} (size: {}) is created on Zone {}.".format(*args))
+    elif event == 'delete':
+        print("File " + str(args[0]) + "'s chunks are marked stale.")
+    elif event == 'append':
+        print("Data {} have been appended to File {}.".format(args[1], args[0]))
+    elif event == 'overwrite':
+        print("Data {} have been overwritten in File {} from offset {}.".format(args[2], args[0], args[1]))
+    elif event == 'move':
+        print("Chunk (", args[0], ",", args[1], ") in zone ", args[2], " is moved to zone " + str(args[3]))
+    elif event == 'gc_move_failed':
+        print("Chunk (", args[0], ",", args[1], ") in zone ", args[2], " can't be moved")
+    elif event == 'reset':
+        print("Zone " + str(args[0]) + " is reset.")
+    elif event == 'close':
+        print("Zone {} is closed.".format(*args))
+    elif event == 'finish':
+        print("Zone {} is finished.".format(*args))
+    elif event == 'gc_done':
+        print("Garbage collection done.")
+
+
 class File:
-    def __init__(self, filesize, inode):
+    # Chunk ids are unique in the file and increase along it, they are not reused
+    # after the chunks are deleted
+    def __init__(self, filesize, inode, chunk_table=None):
         self.size = filesize
         self.data_written = 0
         self.inode = inode
         self.status = 'created'
-        self.chunk_list = []
+        self.chunk_table = chunk_table
+        self.chunk_map = ChunkMap(chunk_table)
+        self.next_chunk_id = 0
+
+    @property
+    def chunk_list(self):
+        return FileChunkList(self.chunk_table, self.chunk_map)
 
-    def addChunk(self, file_chunk):
-        self.chunk_list.append(file_chunk)
+    def addChunk(self, handle):
+        self.chunk_table.in_file[handle] = 1
+        self.chunk_map.append(handle)
+        self.next_chunk_id = self.chunk_table.chunk_id[handle] + 1
+
+    def addChunks(self, handles):
+        in_file = self.chunk_table.in_file
+        for handle in handles:
+            in_file[handle] = 1
+        self.chunk_map.extend(handles)
+        self.next_chunk_id = self.chunk_table.chunk_id[handles[-1]] + 1
 
     def updateChunk(self, new_chunk):
-        for i in range(0, len(self.chunk_list)):
-            if self.chunk_list[i].id == new_chunk.id:
-                self.chunk_list.insert(i, new_chunk)
-                self.chunk_list.pop(i+1)
+        handle = self.chunk_map.findChunk(new_chunk.id)
+        if handle is not None:
+            self.replaceChunk(handle, new_chunk.handle)
+
+    # new_handle takes the place of old_handle, both have the same chunk id and size
+    def replaceChunk(self, old_handle, new_handle):
+        in_file = self.chunk_table.in_file
+        if not in_file[old_handle] or not self.chunk_map.replace(old_handle, new_handle):
+            return False
+        in_file[new_handle] = 1
+        in_file[old_handle] = 0
+        return True
+
+    def deleteChunks(self, beg_id, end_id):
+        chunk_table = self.chunk_table
+        for handle in self.chunk_map.delete(beg_id, end_id):
+            chunk_table.releaseChunk(handle)
+
+    def copy(self, chunk_table):
+        file = File(self.size, self.inode, chunk_table)
+        file.data_written = self.data_written
+        file.status = self.status
+        file.chunk_map = self.chunk_map.copy(chunk_table)
+        file.next_chunk_id = self.next_chunk_id
+        return file
+
+
+class ChunkMap:
+    # Chunk handles of a file in logical order, split into segments of at most
+    # SEGMENT_SIZE handles. The number of chunks and bytes of each segment are kept,
+    # and their prefix sums are rebuilt lazily after a delete. A chunk is found by its
+    # position, its logical byte offset or its id with two bisections, and deleting a
+    # range only moves the handles of the segments it touches.
+    SEGMENT_SIZE = 256
+    __slots__ = ('chunk_table', 'segments', 'segment_sizes', 'ends', 'offsets', 'length', 'size')
+
+    def __init__(self, chunk_table, handles=()):
+        self.chunk_table = chunk_table
+        step = self.SEGMENT_SIZE // 2
+        self.segments = [array('q', handles[i : i + step]) for i in range(0, len(handles), step)]
+        size = chunk_table.size if chunk_table is not None else None
+        self.segment_sizes = [sum(size[handle] for handle in segment) for segment in self.segments]
+        self.ends = None
+        self.offsets = None
+        self.length = len(handles)
+        self.size = sum(self.segment_sizes)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        for segment in self.segments:
+            yield from segment
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            beg, end, step = i.indices(self.length)
+            if step != 1:
+                return array('q', self.toArray()[i])
+            return self.getRange(beg, end)
+        if i < 0:
+            i += self.length
+        if not 0 <= i < self.length:
+            raise IndexError('chunk index out of range')
+        k, j = self.locate(i)
+        return self.segments[k][j]
+
+    def copy(self, chunk_table):
+        chunk_map = ChunkMap.__new__(ChunkMap)
+        chunk_map.chunk_table = chunk_table
+        chunk_map.segments = [segment[:] for segment in self.segments]
+        chunk_map.segment_sizes = self.segment_sizes[:]
+        chunk_map.ends = None
+        chunk_map.offsets = None
+        chunk_map.length = self.length
+        chunk_map.size = self.size
+        return chunk_map
+
+    def toArray(self):
+        handles = array('q')
+        for segment in self.segments:
+            handles.extend(segment)
+        return handles
+
+    def updatePrefixSums(self):
+        self.ends = []
+        self.offsets = []
+        end = offset = 0
+        for segment, size in zip(self.segments, self.segment_sizes):
+            end += len(segment)
+            offset += size
+            self.ends.append(end)
+            self.offsets.append(offset)
+
+    # Segment and index in the segment of the chunk at position i, 0 <= i <= len
+    def locate(self, i):
+        if self.ends is None:
+            self.updatePrefixSums()
+        k = bisect.bisect_right(self.ends, i)
+        if k == len(self.segments):
+            return k, 0
+        return k, i - (self.ends[k - 1] if k else 0)
+
+    def append(self, handle):
+        size = self.chunk_table.size[handle]
+        segments = self.segments
+        if not segments or len(segments[-1]) >= self.SEGMENT_SIZE:
+            segments.append(array('q'))
+            self.segment_sizes.append(0)
+            if self.ends is not None:
+                self.ends.append(self.length)
+                self.offsets.append(self.size)
+        segments[-1].append(handle)
+        self.segment_sizes[-1] += size
+        self.length += 1
+        self.size += size
+        if self.ends is not None:
+            self.ends[-1] += 1
+            self.offsets[-1] += size
+
+    def extend(self, handles):
+        size = self.chunk_table.size
+        segments = self.segments
+        i = 0
+        while i < len(handles):
+            if not segments or len(segments[-1]) >= self.SEGMENT_SIZE:
+                segments.append(array('q'))
+                self.segment_sizes.append(0)
+                if self.ends is not None:
+                    self.ends.append(self.length)
+                    self.offsets.append(self.size)
+            part = handles[i : i + self.SEGMENT_SIZE - len(segments[-1])]
+            part_size = sum(size[handle] for handle in part)
+            segments[-1].extend(part)
+            self.segment_sizes[-1] += part_size
+            self.length += len(part)
+            self.size += part_size
+            if self.ends is not None:
+                self.ends[-1] += len(part)
+                self.offsets[-1] += part_size
+            i += len(part)
+
+    def getRange(self, beg, end):
+        handles = array('q')
+        if beg >= end:
+            return handles
+        k, j = self.locate(beg)
+        count = end - beg
+        while count > 0:
+            segment = self.segments[k]
+            handles.extend(segment[j : j + count])
+            count -= len(segment) - j
+            k += 1
+            j = 0
+        return handles
+
+    # Remove the chunks at positions beg to end - 1, return their handles
+    def delete(self, beg, end):
+        beg, end, _ = slice(beg, end).indices(self.length)
+        handles = array('q')
+        if beg >= end:
+            return handles
+        size = self.chunk_table.size
+        first, j = self.locate(beg)
+        k = first
+        count = end - beg
+        deleted_size = 0
+        while count > 0:
+            segment = self.segments[k]
+            removed = segment[j : j + count]
+            del segment[j : j + count]
+            handles.extend(removed)
+            removed_size = sum(size[handle] for handle in removed)
+            self.segment_sizes[k] -= removed_size
+            deleted_size += removed_size
+            count -= len(removed)
+            k += 1
+            j = 0
+        # Only the first and the last touched segments can be left, they are merged
+        # together, or with the next segment, when small enough
+        if k < len(self.segments) and len(self.segments[k - 1]) + len(self.segments[k]) <= self.SEGMENT_SIZE // 2:
+            k += 1
+        left = [(segment, segment_size) for segment, segment_size
+                in zip(self.segments[first : k], self.segment_sizes[first : k]) if segment]
+        if len(left) > 1 and sum(len(segment) for segment, segment_size in left) <= self.SEGMENT_SIZE:
+            merged = array('q')
+            for segment, segment_size in left:
+                merged.extend(segment)
+            left = [(merged, sum(segment_size for segment, segment_size in left))]
+        self.segments[first : k] = [segment for segment, segment_size in left]
+        self.segment_sizes[first : k] = [segment_size for segment, segment_size in left]
+        self.length -= len(handles)
+        self.size -= deleted_size
+        self.ends = None
+        self.offsets = None
+        return handles
+
+    # Segment and index in the segment of the chunk with this id, None if there is none
+    def findId(self, chunk_id):
+        chunk_ids = self.chunk_table.chunk_id
+        key = lambda handle: chunk_ids[handle]
+        k = bisect.bisect_right(self.segments, chunk_id, key=lambda segment: chunk_ids[segment[0]]) - 1
+        if k < 0:
+            return None
+        segment = self.segments[k]
+        j = bisect.bisect_left(segment, chunk_id, key=key)
+        if j == len(segment) or chunk_ids[segment[j]] != chunk_id:
+            return None
+        return k, j
+
+    def findChunk(self, chunk_id):
+        found = self.findId(chunk_id)
+        if found is None:
+            return None
+        return self.segments[found[0]][found[1]]
+
+    def replace(self, old_handle, new_handle):
+        found = self.findId(self.chunk_table.chunk_id[old_handle])
+        if found is None or self.segments[found[0]][found[1]] != old_handle:
+            return False
+        self.segments[found[0]][found[1]] = new_handle
+        return True
+
+    # Position of the chunk holding the logical byte offset, len if offset is past the end
+    def findOffset(self, offset):
+        if offset >= self.size:
+            return self.length
+        if self.offsets is None:
+            self.updatePrefixSums()
+        k = bisect.bisect_right(self.offsets, offset)
+        position = self.ends[k - 1] if k else 0
+        offset -= self.offsets[k - 1] if k else 0
+        size = self.chunk_table.size
+        for handle in self.segments[k]:
+            offset -= size[handle]
+            if offset < 0:
                 break
+            position += 1
+        return position
+
+
+class LifeClock:
+    # Logical clock of chunk life times, ticked by ZnsFileSystem.updateLifeTime().
+    # A live chunk's life_time is the number of ticks since its birth epoch.
+    def __init__(self):
+        self.now = 0
+
+    def tick(self, ticks=1):
+        self.now += ticks
+
+
+class ChunkTable:
+    # Columnar storage of the file chunks, one row per chunk addressed by an integer
+    # handle. zone_id / block_id are -1 for chunks not (or no longer) stored on the SSD,
+    # in_file is 1 while the chunk's file refers to it.
+    # Rows of erased chunks no file refers to are recycled through free_handles.
+    # deleted_files maps the inode of a deleted file to the number of its chunks still
+    # stored on the SSD. When the last one is erased, the inode goes to reclaimable_files
+    # and ZnsFileSystem.reclaimFiles() frees the file and its rows.
+    def __init__(self):
+        self.inode = array('q')
+        self.chunk_id = array('i')
+        self.zone_id = array('i')
+        self.block_id = array('i')
+        self.size = array('i')
+        self.is_stale = array('b')
+        self.birth = array('q')
+        self.in_file = array('b')
+        self.free_handles = array('q')
+        self.deleted_files = {}
+        self.reclaimable_files = []
+        self.clock = LifeClock()
+        self.ssd = None
+
+    def __len__(self):
+        return len(self.inode) - len(self.free_handles)
+
+    # Copy of the table with its own clock, the columns are copied with memcpy
+    def copy(self):
+        chunk_table = ChunkTable()
+        for column in ('inode', 'chunk_id', 'zone_id', 'block_id', 'size', 'is_stale', 'birth', 'in_file',
+                       'free_handles'):
+            setattr(chunk_table, column, getattr(self, column)[:])
+        chunk_table.deleted_files = self.deleted_files.copy()
+        chunk_table.reclaimable_files = self.reclaimable_files[:]
+        chunk_table.clock.now = self.clock.now
+        return chunk_table
+
+    def newChunk(self, inode, chunk_id, size, birth):
+        if self.free_handles:
+            handle = self.free_handles.pop()
+            self.inode[handle] = inode
+            self.chunk_id[handle] = chunk_id
+            self.size[handle] = size
+            self.is_stale[handle] = 0
+            self.birth[handle] = birth
+            return handle
+        self.inode.append(inode)
+        self.chunk_id.append(chunk_id)
+        self.zone_id.append(-1)
+        self.block_id.append(-1)
+        self.size.append(size)
+        self.is_stale.append(0)
+        self.birth.append(birth)
+        self.in_file.append(0)
+        return len(self.inode) - 1
+
+    # newChunk() of consecutive chunks of a file, stored in consecutive blocks of a
+    # zone from first_block_id. Returns the list of their handles.
+    def newChunks(self, inode, first_chunk_id, sizes, birth, zone_id, first_block_id):
+        handles = []
+        free_handles = self.free_handles
+        while free_handles and len(handles) < len(sizes):
+            handle = free_handles.pop()
+            i = len(handles)
+            self.inode[handle] = inode
+            self.chunk_id[handle] = first_chunk_id + i
+            self.size[handle] = sizes[i]
+            self.is_stale[handle] = 0
+            self.birth[handle] = birth
+            self.zone_id[handle] = zone_id
+            self.block_id[handle] = first_block_id + i
+            handles.append(handle)
+        i = len(handles)
+        count = len(sizes) - i
+        if count:
+            first_handle = len(self.inode)
+            self.inode.extend(array('q', [inode]) * count)
+            self.chunk_id.extend(range(first_chunk_id + i, first_chunk_id + len(sizes)))
+            self.zone_id.extend(array('i', [zone_id]) * count)
+            self.block_id.extend(range(first_block_id + i, first_block_id + len(sizes)))
+            self.size.extend(sizes[i:])
+            self.is_stale.frombytes(bytes(count))
+            self.birth.extend(array('q', [birth]) * count)
+            self.in_file.frombytes(bytes(count))
+            handles.extend(range(first_handle, first_handle + count))
+        return handles
+
+    def freeChunk(self, handle):
+        self.zone_id[handle] = -1
+        self.block_id[handle] = -1
+        self.in_file[handle] = 0
+        self.free_handles.append(handle)
+
+    # Called when the chunk is erased from the SSD
+    def eraseChunk(self, handle):
+        if not self.in_file[handle]:
+            self.freeChunk(handle)
+        else:
+            self.zone_id[handle] = -1
+            self.block_id[handle] = -1
+            self.unrefDeletedFile(self.inode[handle])
+
+    # Called when the chunk is removed from its file
+    def releaseChunk(self, handle):
+        if self.zone_id[handle] < 0:
+            self.freeChunk(handle)
+        else:
+            self.in_file[handle] = 0
+            self.unrefDeletedFile(self.inode[handle])
+
+    # Called when a deleted file is left with num_of_chunks chunks stored on the SSD
+    def addDeletedFile(self, inode, num_of_chunks):
+        if num_of_chunks:
+            self.deleted_files[inode] = num_of_chunks
+        else:
+            self.reclaimable_files.append(inode)
+
+    # One stored chunk of a file less, which makes a deleted file reclaimable after its last one
+    def unrefDeletedFile(self, inode):
+        num_of_chunks = self.deleted_files.get(inode)
+        if num_of_chunks is None:
+            return
+        if num_of_chunks > 1:
+            self.deleted_files[inode] = num_of_chunks - 1
+        else:
+            del self.deleted_files[inode]
+            self.reclaimable_files.append(inode)
+
+    def getLogiUnit(self, handle):
+        zone_id = self.zone_id[handle]
+        if zone_id < 0 or self.ssd is None:
+            return None
+        return Block(self.ssd.group_list[zone_id], self.block_id[handle])
+
+    def getLifeTime(self, handle):
+        if self.is_stale[handle]:
+            return 0
+        return self.clock.now - self.birth[handle]
+
+    def markStale(self, handle):
+        if self.is_stale[handle]:
+            return
+        self.is_stale[handle] = 1
+        zone_id = self.zone_id[handle]
+        if zone_id >= 0 and self.ssd is not None:
+            self.ssd.group_list[zone_id].addBlockCounters(self.block_id[handle], self.size[handle], -1,
+                                                          -self.birth[handle])
+
+    # markStale() on many chunks, the counters of each block and zone they are stored
+    # in are only updated once
+    def markStaleMany(self, handles):
+        is_stale = self.is_stale
+        zone_ids = self.zone_id
+        blocks = {}
+        for handle in handles:
+            if is_stale[handle]:
+                continue
+            is_stale[handle] = 1
+            zone_id = zone_ids[handle]
+            if zone_id < 0:
+                continue
+            key = (zone_id, self.block_id[handle])
+            counters = blocks.get(key)
+            if counters is None:
+                blocks[key] = [self.size[handle], 1, self.birth[handle]]
+            else:
+                counters[0] += self.size[handle]
+                counters[1] += 1
+                counters[2] += self.birth[handle]
+        if blocks and self.ssd is not None:
+            self.ssd.removeLiveCounters(blocks)
+
+    # Bytes of the stored chunks per zone, only the stale (or only the live) ones
+    def sumSizeByZone(self, num_of_zones, is_stale):
+        if numpy is not None:
+            zone_id = numpy.frombuffer(self.zone_id, dtype=numpy.int32)
+            mask = (zone_id >= 0) & (numpy.frombuffer(self.is_stale, dtype=numpy.int8) == is_stale)
+            size = numpy.frombuffer(self.size, dtype=numpy.int32)
+            return numpy.bincount(zone_id[mask], weights=size[mask], minlength=num_of_zones).astype(numpy.int64).tolist()
+        size_list = [0] * num_of_zones
+        for zone_id, size, stale in zip(self.zone_id, self.size, self.is_stale):
+            if zone_id >= 0 and stale == is_stale:
+                size_list[zone_id] += size
+        return size_list
 
 
 class FileChunk:
-    def __init__(self, inode, logi_unit, id, chunck_size, life_time=0):
-        self.inode = inode
-        self.logi_unit = logi_unit # Pointer to the Logical data unit
-        self.id = id
-        self.size = chunck_size
-        self.life_time = life_time
-        self.is_stale = False
+    # Lightweight view of a row of a ChunkTable
+    __slots__ = ('chunk_table', 'handle')
+
+    def __init__(self, chunk_table, handle):
+        self.chunk_table = chunk_table
+        self.handle = handle
+
+    def __eq__(self, other):
+        return isinstance(other, FileChunk) and self.chunk_table is other.chunk_table \
+            and self.handle == other.handle
+
+    def __hash__(self):
+        return hash(self.handle)
+
+    @property
+    def inode(self):
+        return self.chunk_table.inode[self.handle]
+
+    @property
+    def id(self):
+        return self.chunk_table.chunk_id[self.handle]
+
+    @property
+    def size(self):
+        return self.chunk_table.size[self.handle]
+
+    @property
+    def birth(self):
+        return self.chunk_table.birth[self.handle]
+
+    @property
+    def is_stale(self):
+        return self.chunk_table.is_stale[self.handle] == 1
+
+    # Stale chunks do not age, their life time is 0
+    @property
+    def life_time(self):
+        return self.chunk_table.getLifeTime(self.handle)
+
+    # Pointer to the Logical data unit, None once the chunk is erased
+    @property
+    def logi_unit(self):
+        return self.chunk_table.getLogiUnit(self.handle)
 
     def markStale(self):
-        self.is_stale = True
-        self.life_time = 0
+        self.chunk_table.markStale(self.handle)
 
     def print(self):
         print('inode: {}, Chunk {}: size {}, is_stale {}, life {}'.format(self.inode, self.id, self.size, self.is_stale, self.life_time))
 
 
+class FileChunkList:
+    # Read-only sequence of FileChunk views over an array of chunk handles
+    __slots__ = ('chunk_table', 'handles')
+
+    def __init__(self, chunk_table, handles):
+        self.chunk_table = chunk_table
+        self.handles = handles
+
+    def __len__(self):
+        return len(self.handles)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [FileChunk(self.chunk_table, handle) for handle in self.handles[i]]
+        return FileChunk(self.chunk_table, self.handles[i])
+
+    def __iter__(self):
+        for handle in self.handles:
+            yield FileChunk(self.chunk_table, handle)
+
+
+class FileList:
+    # Read-only view of a file_table in the form of the former file_list: indexed by
+    # inode, iterating the File objects
+    __slots__ = ('file_table',)
+
+    def __init__(self, file_table):
+        self.file_table = file_table
+
+    def __len__(self):
+        return len(self.file_table)
+
+    def __getitem__(self, inode):
+        return self.file_table[inode]
+
+    def __iter__(self):
+        return iter(self.file_table.values())
+
+
+class CowList(list):
+    # List of zones or files shared with forks of the file system (see ZnsFileSystem.fork()).
+    # An item is owned by ssd when it uses ssd's ChunkTable. Shared items are never
+    # modified, they are replaced by a copy_item() copy on first access.
+    def __init__(self, ssd, items, copy_item):
+        list.__init__(self, items)
+        self.ssd = ssd
+        self.copy_item = copy_item
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        item = list.__getitem__(self, i)
+        if item.chunk_table is not self.ssd.chunk_table:
+            item = self.copy_item(item)
+            list.__setitem__(self, i, item)
+        return item
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class CowDict(dict):
+    # Dict version of CowList, for the inode table of ZnsFileSystem
+    def __init__(self, ssd, items, copy_item):
+        dict.__init__(self, items)
+        self.ssd = ssd
+        self.copy_item = copy_item
+
+    def __getitem__(self, key):
+        item = dict.__getitem__(self, key)
+        if item.chunk_table is not self.ssd.chunk_table:
+            item = self.copy_item(item)
+            dict.__setitem__(self, key, item)
+        return item
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def values(self):
+        return [self[key] for key in self]
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+
 class LogiDataGroup:
-    def __init__(self, id, num_of_group):
+    __slots__ = ('id', 'num_of_group', 'parent', 'chunk_table', 'remain_space', 'max_space', 'stale_size',
+                 'live_chunks', 'birth_sum')
+
+    def __init__(self, id, num_of_group, chunk_table=None):
         self.id = id
         self.num_of_group = num_of_group
-        self.group_list = []
+        self.parent = None
+        self.chunk_table = chunk_table
         self.remain_space = 0
         self.max_space = 0
+        self.stale_size = 0
+        self.live_chunks = 0
+        self.birth_sum = 0
 
-    # Note! FileSystem needs to call updateRemainSpace() after modifying files
+    # remain_space, stale_size, live_chunks and birth_sum (sum of the live chunks'
+    # birth epochs) are live counters kept up to date by writes, markStale() and
+    # resets. The calc*() methods recompute them from the stored chunks and are
+    # only meant for consistency checks.
     def updateRemainSpace(self):
-        self.remain_space = 0
-        for item in self.group_list:
-            self.remain_space += item.updateRemainSpace()
         return self.remain_space
 
+    def getUsedSize(self):
+        return self.max_space - self.remain_space
+
+    def addChunkCounters(self, stale_size, live_chunks, birth_sum):
+        self.stale_size += stale_size
+        self.live_chunks += live_chunks
+        self.birth_sum += birth_sum
+        if self.parent is not None:
+            self.parent.addChunkCounters(stale_size, live_chunks, birth_sum)
+
+    def calcRemainSpace(self):
+        remain_space = 0
+        for item in self.group_list:
+            remain_space += item.calcRemainSpace()
+        return remain_space
+
+    def calcStaleSize(self):
+        stale_size = 0
+        for item in self.group_list:
+            stale_size += item.calcStaleSize()
+        return stale_size
+
+    def calcLifeTime(self):
+        life_time = 0
+        for item in self.group_list:
+            life_time += item.calcLifeTime()
+        return life_time
+
+    def verifyCounters(self):
+        for item in self.group_list:
+            item.verifyCounters()
+        self.verifyOwnCounters()
+
+    def verifyOwnCounters(self):
+        assert self.remain_space == self.calcRemainSpace(), \
+            '{} {}: remain_space {} != {}'.format(self.name, self.id, self.remain_space, self.calcRemainSpace())
+        assert self.stale_size == self.calcStaleSize(), \
+            '{} {}: stale_size {} != {}'.format(self.name, self.id, self.stale_size, self.calcStaleSize())
+        assert self.getLifeTime() == self.calcLifeTime(), \
+            '{} {}: life_time {} != {}'.format(self.name, self.id, self.getLifeTime(), self.calcLifeTime())
+
     def isFull(self):
         if self.remain_space > 0:
             return False
@@ -60,7 +772,10 @@ class LogiDataGroup:
     def resetState(self):
         for item in self.group_list:
             item.resetState()
-        self.updateRemainSpace()
+        self.remain_space = self.max_space
+        self.stale_size = 0
+        self.live_chunks = 0
+        self.birth_sum = 0
 
     def writeFile(self, file: File):
         # print("writeFile() in ", self.name, self.id) # Debug
@@ -68,15 +783,16 @@ class LogiDataGroup:
             return 0
         data_written = 0
         for item in self.group_list:
-            ret = item.writeFile(file)
-            data_written += ret
-        self.updateRemainSpace()
+            data_written += item.writeFile(file)
+            if file.data_written >= file.size:
+                break
+        self.remain_space -= data_written
         return data_written
 
-    def writeChunk(self, file_chunk):
+    def writeChunk(self, handle):
         for item in self.group_list:
-            if item.writeChunk(file_chunk) == True:
-                self.remain_space -= file_chunk.size
+            if item.writeChunk(handle) == True:
+                self.remain_space -= self.chunk_table.size[handle]
                 return True
         return False
 
@@ -89,16 +805,10 @@ class LogiDataGroup:
             item.markStale(file)
 
     def getStaleSize(self):
-        stale_size = 0
-        for item in self.group_list:
-            stale_size += item.getStaleSize()
-        return stale_size
-    
+        return self.stale_size
+
     def getLifeTime(self):
-        life_time = 0
-        for item in self.group_list:
-            life_time += item.getLifeTime()
-        return life_time
+        return self.live_chunks * self.chunk_table.clock.now - self.birth_sum
 
     def print(self):
         print('{} {}: '.format(self.name, self.id))
@@ -106,136 +816,536 @@ class LogiDataGroup:
             item.print()
 
 
-class LogiDataUnit:
-    def __init__(self, id, zone_id, block_id, max_size):
+class Block:
+    # Lightweight view of a block of a zone. Currently, Block is the basic unit in our
+    # Simulator: it holds the chunks directly, and its counters are columns of the zone.
+    __slots__ = ('zone', 'id')
+    name = 'Block'
+
+    def __init__(self, zone, id):
+        self.zone = zone
         self.id = id
-        self.zone_id = zone_id
-        self.block_id = block_id
-        self.max_size = max_size
-        self.remain_space = max_size
-        self.file_chunk_list = []
 
-    def updateRemainSpace(self):
-        self.remain_space = self.max_size
-        for file_chunk in self.file_chunk_list:
-            self.remain_space -= file_chunk.size
-        return self.remain_space
+    def __eq__(self, other):
+        return isinstance(other, Block) and self.zone is other.zone and self.id == other.id
+
+    def __hash__(self):
+        return hash((self.zone.id, self.id))
+
+    @property
+    def zone_id(self):
+        return self.zone.id
+
+    @property
+    def block_id(self):
+        return self.id
+
+    @property
+    def block_size(self):
+        return self.zone.block_size
+
+    @property
+    def max_space(self):
+        return self.zone.block_size
+
+    @property
+    def remain_space(self):
+        return self.zone.block_remain_space[self.id]
+
+    @property
+    def stale_size(self):
+        return self.zone.block_stale_size[self.id]
+
+    @property
+    def live_chunks(self):
+        return self.zone.block_live_chunks[self.id]
+
+    @property
+    def birth_sum(self):
+        return self.zone.block_birth_sum[self.id]
+
+    # Handles of the chunks stored in the block, in their write order
+    @property
+    def file_chunk_list(self):
+        block_id = self.zone.chunk_table.block_id
+        return array('q', (handle for handle in self.zone.file_chunk_list if block_id[handle] == self.id))
+
+    def getStaleSize(self):
+        return self.stale_size
+
+    def getLifeTime(self):
+        return self.live_chunks * self.zone.chunk_table.clock.now - self.birth_sum
+
+    def print(self):
+        print('Block {}: '.format(self.id))
+        for handle in self.file_chunk_list:
+            FileChunk(self.zone.chunk_table, handle).print()
+
+
+class BlockList:
+    # Read-only sequence of the Block views of the allocated blocks of a zone
+    __slots__ = ('zone',)
+
+    def __init__(self, zone):
+        self.zone = zone
+
+    def __len__(self):
+        return self.zone.write_pointer
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [Block(self.zone, block_id) for block_id in range(self.zone.write_pointer)[i]]
+        return Block(self.zone, range(self.zone.write_pointer)[i])
+
+    def __iter__(self):
+        for block_id in range(self.zone.write_pointer):
+            yield Block(self.zone, block_id)
+
+
+ZONE_STATES = ('empty', 'open', 'closed', 'full')
+
+
+class Zone(LogiDataGroup):
+    name = 'Zone'
+    # Per-block counters, one item per allocated block, and the chunks of the zone
+    columns = (('block_remain_space', 'i'), ('block_stale_size', 'i'), ('block_live_chunks', 'i'),
+               ('block_birth_sum', 'q'), ('file_chunk_list', 'q'))
+
+    # Blocks are allocated lazily: only the blocks written so far have counters, and
+    # they always form a prefix of the zone. The remaining blocks are implicitly empty.
+    # The counters of the blocks are kept in columns (arrays) of the zone, and
+    # file_chunk_list holds the handles of all the chunks stored in the zone in their
+    # write order. A chunk's block is its block_id in the ChunkTable.
+    # write_pointer is the next unallocated block, and every block before
+    # first_free_block is full, so writes never rescan the filled part of the zone.
+    # state is one of ZONE_STATES, see SSD.openZone().
+    def __init__(self, id, num_of_group=32768, block_size=4096, chunk_table=None):
+        super().__init__(id, num_of_group, chunk_table)
+        self.block_size = block_size
+        self.max_space = self.num_of_group * self.block_size
+        self.remain_space = self.max_space
+        self.write_pointer = 0
+        self.first_free_block = 0
+        self.state = 'empty'
+        self.clearBlocks()
+
+    def clearBlocks(self):
+        for column, typecode in Zone.columns:
+            setattr(self, column, array(typecode))
+
+    @property
+    def group_list(self):
+        return BlockList(self)
+
+    # Copy of the zone for a new parent, see ZnsFileSystem.fork()
+    def copyGroup(self, parent):
+        zone = Zone.__new__(Zone)
+        for name in LogiDataGroup.__slots__:
+            setattr(zone, name, getattr(self, name))
+        zone.__dict__.update(self.__dict__)
+        zone.parent = parent
+        zone.chunk_table = parent.chunk_table
+        for column, typecode in Zone.columns:
+            setattr(zone, column, getattr(self, column)[:])
+        return zone
+
+    # The rest of the zone can't be written until the reset, return the lost space
+    def finish(self):
+        remain_space = self.remain_space
+        self.remain_space = 0
+        self.state = 'full'
+        return remain_space
+
+    # Allocate the block at the write pointer, return its id
+    def newBlock(self):
+        self.block_remain_space.append(self.block_size)
+        self.block_stale_size.append(0)
+        self.block_live_chunks.append(0)
+        self.block_birth_sum.append(0)
+        self.write_pointer += 1
+        return self.write_pointer - 1
+
+    def updateFirstFreeBlock(self):
+        while self.first_free_block < self.write_pointer \
+                and self.block_remain_space[self.first_free_block] == 0:
+            self.first_free_block += 1
+
+    def addBlockCounters(self, block_id, stale_size, live_chunks, birth_sum):
+        self.block_stale_size[block_id] += stale_size
+        self.block_live_chunks[block_id] += live_chunks
+        self.block_birth_sum[block_id] += birth_sum
+        self.addChunkCounters(stale_size, live_chunks, birth_sum)
+
+    def addChunkCounters(self, stale_size, live_chunks, birth_sum):
+        super().addChunkCounters(stale_size, live_chunks, birth_sum)
+        if self.parent is not None:
+            self.parent.dirty_zones.add(self.id)
+
+    # Handles of the stored chunks in the order of their blocks, and in write order
+    # within a block
+    def getChunkHandles(self):
+        return sorted(self.file_chunk_list, key=self.chunk_table.block_id.__getitem__)
+
+    def calcRemainSpace(self):
+        if self.state == 'full':
+            return 0
+        size = self.chunk_table.size
+        return self.max_space - sum(size[handle] for handle in self.file_chunk_list)
+
+    def calcStaleSize(self):
+        size = self.chunk_table.size
+        is_stale = self.chunk_table.is_stale
+        return sum(size[handle] for handle in self.file_chunk_list if is_stale[handle])
+
+    def calcLifeTime(self):
+        return sum(self.chunk_table.getLifeTime(handle) for handle in self.file_chunk_list)
+
+    # The counters of the blocks are checked in one pass over the chunks of the zone
+    def verifyCounters(self):
+        chunk_table = self.chunk_table
+        remain_space = [self.block_size] * self.write_pointer
+        stale_size = [0] * self.write_pointer
+        life_time = [0] * self.write_pointer
+        for handle in self.file_chunk_list:
+            assert chunk_table.zone_id[handle] == self.id, \
+                'Zone {}: chunk {} is in zone {}'.format(self.id, handle, chunk_table.zone_id[handle])
+            block_id = chunk_table.block_id[handle]
+            remain_space[block_id] -= chunk_table.size[handle]
+            if chunk_table.is_stale[handle]:
+                stale_size[block_id] += chunk_table.size[handle]
+            life_time[block_id] += chunk_table.getLifeTime(handle)
+        for block in self.group_list:
+            assert block.remain_space == remain_space[block.id], \
+                'Block ({}, {}): remain_space {} != {}'.format(self.id, block.id, block.remain_space, remain_space[block.id])
+            assert block.stale_size == stale_size[block.id], \
+                'Block ({}, {}): stale_size {} != {}'.format(self.id, block.id, block.stale_size, stale_size[block.id])
+            assert block.getLifeTime() == life_time[block.id], \
+                'Block ({}, {}): life_time {} != {}'.format(self.id, block.id, block.getLifeTime(), life_time[block.id])
+        self.verifyOwnCounters()
 
     def resetState(self):
-        self.file_chunk_list.clear()
-        self.remain_space = self.max_size
+        # Erased chunks are detached from the zone, so marking them stale later has no effect
+        for handle in self.getChunkHandles():
+            self.chunk_table.eraseChunk(handle)
+        self.clearBlocks()
+        self.remain_space = self.max_space
+        self.stale_size = 0
+        self.live_chunks = 0
+        self.birth_sum = 0
+        self.write_pointer = 0
+        self.first_free_block = 0
+        self.state = 'empty'
 
     def writeFile(self, file: File):
-        ''' Debug
-        print('writeFile() in LogiDataUnit, max_size=', self.max_size, ', remain=',self.remain_space)
-        print('Before: Data written', file.data_written, '/', file.size, '; ', end='')
-        '''
-        if self.remain_space == 0:
+        if self.state == 'full':
             return 0
-        if file.data_written >= file.size:
-            return 0
-        file_remain_size = file.size - file.data_written
         data_written = 0
-        if file_remain_size >= self.remain_space:
-            data_written = self.remain_space
-            self.remain_space = 0
-        else:
-            data_written = file_remain_size
-            self.remain_space -= file_remain_size
-        new_chunk = FileChunk(file.inode, self, len(file.chunk_list), data_written)
+        block_id = self.first_free_block
+        while file.data_written < file.size and block_id < self.num_of_group:
+            if block_id == self.write_pointer and file.size - file.data_written > self.block_size:
+                data_written += self.writeNewBlocks(file)
+                break
+            data_written += self.writeFileToBlock(file, block_id)
+            block_id += 1
+        self.remain_space -= data_written
+        self.updateFirstFreeBlock()
+        return data_written
+
+    # Write the next chunk of the file to the block, as much as fits in it
+    def writeFileToBlock(self, file: File, block_id):
+        if block_id == self.write_pointer:
+            self.newBlock()
+        remain_space = self.block_remain_space[block_id]
+        if remain_space == 0:
+            return 0
+        data_written = min(file.size - file.data_written, remain_space)
+        self.block_remain_space[block_id] = remain_space - data_written
+        chunk_table = self.chunk_table
+        birth = chunk_table.clock.now
+        handle = chunk_table.newChunk(file.inode, file.next_chunk_id, data_written, birth)
+        chunk_table.zone_id[handle] = self.id
+        chunk_table.block_id[handle] = block_id
         # addChunk will update file.data_written
-        file.addChunk(new_chunk)
+        file.addChunk(handle)
         file.data_written += data_written
-        self.file_chunk_list.append(new_chunk)
+        self.file_chunk_list.append(handle)
+        self.addBlockCounters(block_id, 0, 1, birth)
+        return data_written
 
-        # print('After: Data written', file.data_written, '/', file.size) # Debug
+    # Sequential write of the rest of the file to new blocks from the write pointer,
+    # one chunk per block. The chunks and the block counters are created in bulk, and
+    # the counters of the zone and the SSD are updated once.
+    def writeNewBlocks(self, file: File):
+        block_size = self.block_size
+        file_remain_size = file.size - file.data_written
+        num_of_chunks = min(-(-file_remain_size // block_size), self.num_of_group - self.write_pointer)
+        data_written = min(file_remain_size, num_of_chunks * block_size)
+        sizes = [block_size] * num_of_chunks
+        sizes[-1] = data_written - (num_of_chunks - 1) * block_size
+        birth = self.chunk_table.clock.now
+        handles = self.chunk_table.newChunks(file.inode, file.next_chunk_id, sizes, birth, self.id,
+                                             self.write_pointer)
+        self.block_remain_space.frombytes(bytes(4 * (num_of_chunks - 1)))
+        self.block_remain_space.append(block_size - sizes[-1])
+        self.block_stale_size.frombytes(bytes(4 * num_of_chunks))
+        self.block_live_chunks.extend(array('i', [1]) * num_of_chunks)
+        self.block_birth_sum.extend(array('q', [birth]) * num_of_chunks)
+        self.file_chunk_list.extend(handles)
+        self.write_pointer += num_of_chunks
+        file.addChunks(handles)
+        file.data_written += data_written
+        self.addChunkCounters(0, num_of_chunks, num_of_chunks * birth)
         return data_written
 
-    def writeChunk(self, file_chunk):
-        if self.remain_space == 0:
+    # Store the chunk in the block if it fits
+    def writeChunkToBlock(self, handle, block_id):
+        remain_space = self.block_remain_space[block_id]
+        if remain_space == 0:
             return False
-        if file_chunk.size > self.remain_space:
+        chunk_table = self.chunk_table
+        size = chunk_table.size[handle]
+        if size > remain_space:
             return False
-        file_chunk.logi_unit = self
-        self.file_chunk_list.append(file_chunk)
-        self.remain_space -= file_chunk.size
+        chunk_table.zone_id[handle] = self.id
+        chunk_table.block_id[handle] = block_id
+        self.file_chunk_list.append(handle)
+        self.block_remain_space[block_id] = remain_space - size
+        if chunk_table.is_stale[handle]:
+            self.addBlockCounters(block_id, size, 0, 0)
+        else:
+            self.addBlockCounters(block_id, 0, 1, chunk_table.birth[handle])
         return True
 
-    def markStale(self, file: File):
-        for file_chunk in self.file_chunk_list:
-            if file_chunk.inode == file.inode:
-                file_chunk.markStale(True)
+    def writeChunk(self, handle):
+        size = self.chunk_table.size[handle]
+        if size > self.remain_space:
+            return False
+        for block_id in range(self.first_free_block, self.write_pointer):
+            if self.writeChunkToBlock(handle, block_id):
+                self.remain_space -= size
+                self.updateFirstFreeBlock()
+                return True
+        if self.write_pointer < self.num_of_group and size <= self.block_size:
+            if self.writeChunkToBlock(handle, self.newBlock()):
+                self.remain_space -= size
+                self.updateFirstFreeBlock()
+                return True
+        return False
 
-    def getStaleSize(self):
-        stale_size = 0
-        for file_chunk in self.file_chunk_list:
-            if file_chunk.is_stale:
-                stale_size += file_chunk.size
-        return stale_size
+    # Append a chunk at the write pointer, i.e. into the last written block or a new one.
+    # Falls back to writeChunk() when neither has room.
+    def appendChunk(self, handle):
+        size = self.chunk_table.size[handle]
+        if size > self.remain_space:
+            return False
+        if self.write_pointer > 0 and self.writeChunkToBlock(handle, self.write_pointer - 1):
+            pass
+        elif self.write_pointer < self.num_of_group and size <= self.block_size:
+            self.writeChunkToBlock(handle, self.newBlock())
+        else:
+            return self.writeChunk(handle)
+        self.remain_space -= size
+        self.updateFirstFreeBlock()
+        return True
 
     def getFileChunkList(self, file_chunk_list):
-        for file_chunk in self.file_chunk_list:
-            file_chunk_list.append(file_chunk)
+        for handle in self.getChunkHandles():
+            file_chunk_list.append(FileChunk(self.chunk_table, handle))
 
-    def getLifeTime(self):
-        life_time = 0
-        for file_chunk in self.file_chunk_list:
-            life_time += file_chunk.life_time
-        return life_time
+    def markStale(self, file: File):
+        for handle in self.file_chunk_list:
+            if self.chunk_table.inode[handle] == file.inode:
+                self.chunk_table.markStale(handle)
 
     def print(self):
-        for file_chunk in self.file_chunk_list:
-            file_chunk.print()
+        print('{} {}: '.format(self.name, self.id))
+        handles = self.getChunkHandles()
+        block_id = self.chunk_table.block_id
+        i = 0
+        for block in range(self.num_of_group):
+            print('Block {}: '.format(block))
+            while i < len(handles) and block_id[handles[i]] == block:
+                FileChunk(self.chunk_table, handles[i]).print()
+                i += 1
 
 
-class Block(LogiDataGroup):
-    # default size is 4K
-    def __init__(self, id, zone_id, block_size=4096):
-        num_of_group=1 # Currently, Block is the basic unit in our Simulator
-        super().__init__(id, num_of_group)
-        self.name = 'Block'
-        self.zone_id = zone_id
-        self.num_of_group = num_of_group
-        self.block_size = block_size
+class ZoneIndex:
+    # Max segment tree over zone ids. Finds the leftmost zone holding the max value,
+    # or the leftmost zone with at least a given value, in O(log(num_of_zones)).
+    def __init__(self, values):
+        self.size = 1
+        while self.size < len(values):
+            self.size *= 2
+        self.tree = [-1] * (2 * self.size)
+        self.tree[self.size : self.size + len(values)] = values
+        for i in range(self.size - 1, 0, -1):
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
 
-        for i in range(self.num_of_group):
-            self.group_list.append(LogiDataUnit(i, self.zone_id, self.id, block_size))
-        self.max_space = len(self.group_list)*self.block_size
-        self.remain_space = self.max_space
+    def copy(self):
+        zone_index = ZoneIndex([])
+        zone_index.size = self.size
+        zone_index.tree = self.tree[:]
+        return zone_index
 
+    def update(self, i, value):
+        i += self.size
+        self.tree[i] = value
+        i //= 2
+        while i > 0:
+            new_value = max(self.tree[2 * i], self.tree[2 * i + 1])
+            if self.tree[i] == new_value:
+                break
+            self.tree[i] = new_value
+            i //= 2
 
-class Zone(LogiDataGroup):
-    def __init__(self, id, num_of_group=32768, block_size=4096):
-        super().__init__(id, num_of_group)
-        self.name = 'Zone'
+    def get(self, i):
+        return self.tree[self.size + i]
 
-        for i in range(self.num_of_group):
-            self.group_list.append(Block(i, self.id, block_size))
-        self.remain_space = self.updateRemainSpace()
-        self.max_space = self.remain_space
+    def getMax(self):
+        return self.tree[1]
+
+    def argMax(self):
+        node = 1
+        while node < self.size:
+            node *= 2
+            if self.tree[node] != self.tree[node // 2]:
+                node += 1
+        return node - self.size
+
+    def findFirst(self, min_value, beg=0):
+        return self.searchFirst(1, 0, self.size, min_value, beg)
+
+    def searchFirst(self, node, lo, hi, min_value, beg):
+        if hi <= beg or self.tree[node] < min_value:
+            return -1
+        if node >= self.size:
+            return lo
+        mid = (lo + hi) // 2
+        i = self.searchFirst(2 * node, lo, mid, min_value, beg)
+        if i == -1:
+            i = self.searchFirst(2 * node + 1, mid, hi, min_value, beg)
+        return i
+
+
+class ZoneStats:
+    # Counters of all zones in arrays, NumPy arrays if NumPy is installed, so that
+    # statistics over all zones are single vectorized expressions. SSD refreshes
+    # them from its dirty zones together with its GC indexes, see SSD.getZoneStats().
+    def __init__(self, zones):
+        self.max_space = self.newColumn([zone.max_space for zone in zones])
+        self.remain_space = self.newColumn([zone.remain_space for zone in zones])
+        self.stale_size = self.newColumn([zone.stale_size for zone in zones])
+        self.live_chunks = self.newColumn([zone.live_chunks for zone in zones])
+        self.birth_sum = self.newColumn([zone.birth_sum for zone in zones])
+
+    def newColumn(self, values):
+        if numpy is not None:
+            return numpy.array(values, dtype=numpy.int64)
+        return array('q', values)
+
+    def update(self, zone):
+        self.remain_space[zone.id] = zone.remain_space
+        self.stale_size[zone.id] = zone.stale_size
+        self.live_chunks[zone.id] = zone.live_chunks
+        self.birth_sum[zone.id] = zone.birth_sum
+
+    def copy(self):
+        zone_stats = ZoneStats.__new__(ZoneStats)
+        for name in ('max_space', 'remain_space', 'stale_size', 'live_chunks', 'birth_sum'):
+            setattr(zone_stats, name, copy.copy(getattr(self, name)))
+        return zone_stats
+
+    # The following need NumPy
+    def getUsedSize(self):
+        return self.max_space - self.remain_space
+
+    def getLiveSize(self):
+        return self.max_space - self.remain_space - self.stale_size
+
+    def getLifeTime(self, now):
+        return self.live_chunks * now - self.birth_sum
+
+    # zone_life_time_ratio of all zones
+    def getLifeTimeRatio(self, now, block_size):
+        live_size = self.getLiveSize()
+        ratio = numpy.zeros(len(live_size))
+        has_live = live_size > 0
+        ratio[has_live] = self.getLifeTime(now)[has_live] * block_size / live_size[has_live]
+        return ratio
 
 
 class SSD(LogiDataGroup):
+    name = 'SSD'
+
     # Default number of zones is 32
-    def __init__(self, id, num_of_zones=32, num_of_blocks=32768, block_size=4096):
-        super().__init__(id, num_of_zones)
-        self.name = 'SSD'
+    # max_open_zones / max_active_zones limit the number of open zones and of active
+    # (open or closed) zones, 0 is unlimited. See openZone().
+    def __init__(self, id, num_of_zones=32, num_of_blocks=32768, block_size=4096, chunk_table=None,
+                 max_open_zones=0, max_active_zones=0):
+        super().__init__(id, num_of_zones, chunk_table if chunk_table is not None else ChunkTable())
+        self.chunk_table.ssd = self
+        self.group_list = []
         self.num_of_zones = num_of_zones
         self.num_of_blocks = num_of_blocks
         self.block_size = block_size
         self.max_space = num_of_zones * num_of_blocks * block_size
         self.remain_space = self.max_space
         self.zone_life_time_ratio = []
+        self.clock = self.chunk_table.clock
+        # Every zone before first_free_zone is full
+        self.first_free_zone = 0
         for i in range(self.num_of_group):
-            self.group_list.append(Zone(i, num_of_blocks, block_size))
+            zone = Zone(i, num_of_blocks, block_size, self.chunk_table)
+            zone.parent = self
+            self.group_list.append(zone)
             self.zone_life_time_ratio.append(0)
+        # GC indexes of the zones by stale size and by remain space. Zones whose
+        # counters changed are queued in dirty_zones and refreshed on the next query.
+        self.stale_index = ZoneIndex([0] * self.num_of_zones)
+        self.free_index = ZoneIndex([zone.remain_space for zone in self.group_list])
+        self.zone_stats = ZoneStats(self.group_list)
+        self.dirty_zones = set()
+        self.max_open_zones = max_open_zones
+        self.max_active_zones = max_active_zones
+        # Ids of the open zones, least recently used first, and of the active zones
+        self.open_zones = {}
+        self.active_zones = {}
+        # Optional TimingModel of the device work (see zns_timing.py)
+        self.timing = None
 
+    # Without zone limits, files fill the zones in order from first_free_zone. With
+    # limits, they are written to the open zones, see getOpenZone().
     def writeFile(self, file: File):
         if file.size - file.data_written > self.remain_space:
             #print("Error! Not enough space in ", self.name, ' Filesize: ', file.size, ', Remain: ', self.remain_space) #debug
             return -1
-        return super().writeFile(file)
+        if file.data_written >= file.size:
+            return 0
+        data_written = 0
+        if self.max_open_zones or self.max_active_zones:
+            while file.data_written < file.size:
+                zone_id = self.getOpenZone()
+                if zone_id == -1:
+                    break
+                data_written += self.writeFileOnZone(file, zone_id)
+        else:
+            zone_id = self.first_free_zone
+            while file.data_written < file.size and zone_id < self.num_of_zones:
+                if self.openZone(zone_id):
+                    data_written += self.writeFileOnZone(file, zone_id)
+                zone_id += 1
+        self.remain_space -= data_written
+        self.updateFirstFreeZone()
+        return data_written
     
+    def writeFileOnZone(self, file: File, zone_id):
+        data_written = self.group_list[zone_id].writeFile(file)
+        self.dirty_zones.add(zone_id)
+        self.updateZoneState(zone_id)
+        if self.timing is not None and data_written:
+            self.timing.program(zone_id, data_written)
+        return data_written
+
     def appendFile(self, file: File, data_size):
         if data_size > self.remain_space:
             return -1
@@ -244,197 +1354,1104 @@ class SSD(LogiDataGroup):
         return self.writeFile(file)
     
     def writeFileToZone(self, file: File, zone_id, new_data_size):
-        if new_data_size > self.group_list[zone_id].remain_space:
+        if new_data_size > self.group_list[zone_id].remain_space or not self.openZone(zone_id):
             #print("Error! Not enough space in Zone ", zone_id, ' Filesize: ', file.size, ', Remain: ', self.group_list[zone_id].remaind_space) #debug
             return -1
         else:
             file.data_written = file.size
             file.size += new_data_size
-            return self.group_list[zone_id].writeFile(file)
+            data_written = self.writeFileOnZone(file, zone_id)
+            self.remain_space -= data_written
+            self.updateFirstFreeZone()
+            return data_written
+
+    def writeChunkToZone(self, handle, zone_id, append=False):
+        if not self.openZone(zone_id):
+            return False
+        zone = self.group_list[zone_id]
+        written = zone.appendChunk(handle) if append else zone.writeChunk(handle)
+        if written == True:
+            self.dirty_zones.add(zone_id)
+            self.updateZoneState(zone_id)
+            self.remain_space -= self.chunk_table.size[handle]
+            self.updateFirstFreeZone()
+            if self.timing is not None:
+                self.timing.program(zone_id, self.chunk_table.size[handle])
+            return True
+        return False
+
+    # Zone state machine. A zone is 'empty' after a reset and opened by its first
+    # write. An open zone can be 'closed' to give up its open slot, it stays active
+    # and its next write opens it again. A zone is 'full' when it has no space left or
+    # is finished, until its reset. Return False if the zone can't be opened: it is
+    # full, or it is empty and max_active_zones are active. When max_open_zones are
+    # open, the least recently used one is closed.
+    def openZone(self, zone_id):
+        state = self.peekZone(zone_id).state
+        if state == 'open':
+            if self.max_open_zones:
+                del self.open_zones[zone_id]
+                self.open_zones[zone_id] = None
+            return True
+        if state == 'full':
+            return False
+        if state == 'empty' and self.max_active_zones and len(self.active_zones) >= self.max_active_zones:
+            return False
+        if self.max_open_zones and len(self.open_zones) >= self.max_open_zones:
+            self.closeZone(next(iter(self.open_zones)))
+        self.group_list[zone_id].state = 'open'
+        self.open_zones[zone_id] = None
+        self.active_zones[zone_id] = None
+        return True
+
+    def closeZone(self, zone_id):
+        if self.peekZone(zone_id).state != 'open':
+            return False
+        self.group_list[zone_id].state = 'closed'
+        del self.open_zones[zone_id]
+        return True
+
+    # The remaining space of the zone is lost until its reset
+    def finishZone(self, zone_id):
+        if self.peekZone(zone_id).state == 'full':
+            return False
+        self.remain_space -= self.group_list[zone_id].finish()
+        self.open_zones.pop(zone_id, None)
+        self.active_zones.pop(zone_id, None)
+        self.dirty_zones.add(zone_id)
+        self.updateFirstFreeZone()
+        return True
+
+    # Called after a write to the zone
+    def updateZoneState(self, zone_id):
+        zone = self.peekZone(zone_id)
+        if zone.remain_space == 0 and zone.state != 'full':
+            self.group_list[zone_id].state = 'full'
+            self.open_zones.pop(zone_id, None)
+            self.active_zones.pop(zone_id, None)
+
+    # Zone for the next write when the zones are limited: the last used open zone,
+    # else a closed zone opened again, else an empty zone. -1 if none can be opened.
+    def getOpenZone(self):
+        if self.open_zones:
+            return next(reversed(self.open_zones))
+        for zone_id in self.active_zones:
+            if self.openZone(zone_id):
+                return zone_id
+        zone_id = self.findEmptyZone()
+        if zone_id == -1 or not self.openZone(zone_id):
+            return -1
+        return zone_id
+
+    def getZoneState(self, zone_id):
+        return self.peekZone(zone_id).state
+
+    def updateFirstFreeZone(self):
+        while self.first_free_zone < self.num_of_zones \
+                and self.peekZone(self.first_free_zone).remain_space == 0:
+            self.first_free_zone += 1
+
+    # Zone to read counters from. Unlike group_list[zone_id], it does not copy a zone
+    # shared with a fork, so it must not be modified or used to read chunks.
+    def peekZone(self, zone_id):
+        return list.__getitem__(self.group_list, zone_id)
+
+    def resetState(self):
+        super().resetState()
+        self.first_free_zone = 0
+        self.open_zones.clear()
+        self.active_zones.clear()
+        self.dirty_zones.update(range(self.num_of_zones))
+
+    def resetZone(self, zone_id):
+        zone = self.group_list[zone_id]
+        self.remain_space += zone.max_space - zone.remain_space
+        self.stale_size -= zone.stale_size
+        self.live_chunks -= zone.live_chunks
+        self.birth_sum -= zone.birth_sum
+        zone.resetState()
+        self.open_zones.pop(zone_id, None)
+        self.active_zones.pop(zone_id, None)
+        self.dirty_zones.add(zone_id)
+        self.first_free_zone = min(self.first_free_zone, zone_id)
+        if self.timing is not None:
+            self.timing.reset(zone_id)
+
+    # Counters of chunks marked stale: blocks maps (zone_id, block_id) to the stale_size,
+    # live_chunks and birth_sum of the block's chunks marked stale
+    def removeLiveCounters(self, blocks):
+        zones = {}
+        for (zone_id, block_id), (stale_size, live_chunks, birth_sum) in blocks.items():
+            zone = self.group_list[zone_id]
+            zone.block_stale_size[block_id] += stale_size
+            zone.block_live_chunks[block_id] -= live_chunks
+            zone.block_birth_sum[block_id] -= birth_sum
+            counters = zones.get(zone_id)
+            if counters is None:
+                zones[zone_id] = [stale_size, live_chunks, birth_sum]
+            else:
+                counters[0] += stale_size
+                counters[1] += live_chunks
+                counters[2] += birth_sum
+        for zone_id, (stale_size, live_chunks, birth_sum) in zones.items():
+            zone = self.group_list[zone_id]
+            zone.stale_size += stale_size
+            zone.live_chunks -= live_chunks
+            zone.birth_sum -= birth_sum
+            self.stale_size += stale_size
+            self.live_chunks -= live_chunks
+            self.birth_sum -= birth_sum
+            self.dirty_zones.add(zone_id)
+
+    def updateZoneIndex(self):
+        for zone_id in self.dirty_zones:
+            zone = self.peekZone(zone_id)
+            self.stale_index.update(zone_id, zone.stale_size)
+            self.free_index.update(zone_id, zone.remain_space)
+            self.zone_stats.update(zone)
+        self.dirty_zones.clear()
+
+    # Up to date ZoneStats of all zones
+    def getZoneStats(self):
+        self.updateZoneIndex()
+        return self.zone_stats
+
+    # Zone with the max stale size (the lowest id on ties), -1 if nothing is stale
+    def getMaxStaleZone(self):
+        self.updateZoneIndex()
+        if self.stale_index.getMax() <= 0:
+            return -1
+        return self.stale_index.argMax()
+
+    # First zone with at least data_size remain space, -1 if there is none. When
+    # max_active_zones are active, only the active zones can be written.
+    def findFreeZone(self, data_size, exclude_zone_ids=()):
+        if self.max_active_zones and len(self.active_zones) >= self.max_active_zones:
+            for zone_id in self.active_zones:
+                if zone_id not in exclude_zone_ids and self.peekZone(zone_id).remain_space >= data_size:
+                    return zone_id
+            return -1
+        self.updateZoneIndex()
+        zone_id = self.free_index.findFirst(data_size)
+        while zone_id != -1 and zone_id in exclude_zone_ids:
+            zone_id = self.free_index.findFirst(data_size, zone_id + 1)
+        return zone_id
+
+    # First zone that was never written since its last reset, -1 if there is none
+    def findEmptyZone(self, exclude_zone_ids=()):
+        return self.findFreeZone(self.num_of_blocks * self.block_size, exclude_zone_ids)
     
-    def updateZoneLifeTimeRatio(self):
-        for i, zone in enumerate(self.group_list):
+    # Update the ratio of all zones, or only of zone_id if it is given
+    def updateZoneLifeTimeRatio(self, zone_id=None):
+        if zone_id is None and numpy is not None:
+            ratio = self.getZoneStats().getLifeTimeRatio(self.clock.now, self.block_size)
+            self.zone_life_time_ratio[:] = ratio.tolist()
+            return
+        zone_ids = range(self.num_of_zones) if zone_id is None else (zone_id,)
+        now = self.clock.now
+        for i in zone_ids:
+            zone = self.peekZone(i)
             zone_stale = zone.getStaleSize()
             total_life_time = zone.max_space - zone_stale - zone.remain_space
             if total_life_time > 0:
-                self.zone_life_time_ratio[i] = zone.getLifeTime()*self.block_size / total_life_time
+                zone_life_time = zone.live_chunks * now - zone.birth_sum
+                self.zone_life_time_ratio[i] = zone_life_time*self.block_size / total_life_time
             else:
                 self.zone_life_time_ratio[i] = 0
 
+    def verifyCounters(self):
+        super().verifyCounters()
+        zone_stale_sizes = self.chunk_table.sumSizeByZone(self.num_of_zones, True)
+        for zone, stale_size in zip(self.group_list, zone_stale_sizes):
+            assert zone.stale_size == stale_size, \
+                'Zone {}: stale_size {} != {} in ChunkTable'.format(zone.id, zone.stale_size, stale_size)
+
+    # Copy of the SSD sharing all zones copy-on-write, see ZnsFileSystem.fork()
+    def fork(self):
+        self.updateZoneIndex()
+        chunk_table = self.chunk_table
+        # The current table is left to the shared zones and files. Both SSDs switch to
+        # a table of their own, so that they copy every shared zone before using it.
+        self.setChunkTable(copy.copy(chunk_table))
+        ssd = SSD.__new__(SSD)
+        for name in LogiDataGroup.__slots__:
+            setattr(ssd, name, getattr(self, name))
+        ssd.__dict__.update(self.__dict__)
+        ssd.setChunkTable(chunk_table.copy())
+        ssd.zone_life_time_ratio = self.zone_life_time_ratio[:]
+        ssd.stale_index = self.stale_index.copy()
+        ssd.free_index = self.free_index.copy()
+        ssd.zone_stats = self.zone_stats.copy()
+        ssd.dirty_zones = set()
+        ssd.open_zones = self.open_zones.copy()
+        ssd.active_zones = self.active_zones.copy()
+        ssd.timing = None
+        zones = list.copy(self.group_list)
+        for fork in (self, ssd):
+            fork.group_list = CowList(fork, zones, fork.copyZone)
+        return ssd
+
+    def setChunkTable(self, chunk_table):
+        self.chunk_table = chunk_table
+        self.clock = chunk_table.clock
+        chunk_table.ssd = self
+
+    def copyZone(self, zone):
+        return zone.copyGroup(self)
+
     def getFileChunk(self, zone_id, block_id, chunk_id):
-        return self.group_list[zone_id].group_list[block_id].group_list[0].file_chunk_list[chunk_id]
+        handle = self.group_list[zone_id].group_list[block_id].file_chunk_list[chunk_id]
+        return FileChunk(self.chunk_table, handle)
+
+
+class GCPolicy:
+    # Base class of the garbage collection policies of ZnsFileSystem.
+    # needGC() decides whether to run at all, selectVictim() returns the zone to reset
+    # (-1 for none) and selectDestination() the zone a live chunk of the victim is
+    # moved to (-1 if the chunk cannot be moved).
+    def needGC(self, fs):
+        # Trigger GC when total data size exceeds GC threshold
+        ssd = fs.ssd
+        return (ssd.max_space - ssd.remain_space) / ssd.max_space > fs.gc_threshold
+
+    def selectVictim(self, fs):
+        raise NotImplementedError
+
+    def selectDestination(self, fs, file_chunk, victim_zone_id):
+        return fs.ssd.findFreeZone(file_chunk.size, exclude_zone_ids=(victim_zone_id,))
+
+
+class GreedyPolicy(GCPolicy):
+    # Reset the zone with the most stale data, move live chunks to the first zone with room
+    def selectVictim(self, fs):
+        return fs.ssd.getMaxStaleZone()
+
+
+class CostBenefitPolicy(GCPolicy):
+    # LFS-style cost-benefit: reset the zone maximizing (1 - u) * (1 + age) / (1 + u),
+    # where u is the zone's live data ratio and age its zone_life_time_ratio.
+    # Only zones holding stale data are scored, all at once with NumPy.
+    def selectVictim(self, fs):
+        ssd = fs.ssd
+        if numpy is not None:
+            return self.selectVictimVectorized(ssd)
+        ssd.updateZoneIndex()
+        stale_list = ssd.stale_index.tree[ssd.stale_index.size : ssd.stale_index.size + ssd.num_of_zones]
+        max_score = 0
+        zone_id = -1
+        for i, stale_size in enumerate(stale_list):
+            if stale_size <= 0:
+                continue
+            zone = ssd.peekZone(i)
+            ssd.updateZoneLifeTimeRatio(i)
+            utilization = (zone.getUsedSize() - stale_size) / zone.max_space
+            score = (1 - utilization) * (1 + ssd.zone_life_time_ratio[i]) / (1 + utilization)
+            if max_score < score:
+                max_score = score
+                zone_id = i
+        return zone_id
+
+    def selectVictimVectorized(self, ssd):
+        zone_stats = ssd.getZoneStats()
+        has_stale = zone_stats.stale_size > 0
+        if not has_stale.any():
+            return -1
+        # Only the scored zones' ratios are updated, like in the loop above
+        life_time_ratio = numpy.array(ssd.zone_life_time_ratio, dtype=numpy.float64)
+        life_time_ratio[has_stale] = zone_stats.getLifeTimeRatio(ssd.clock.now, ssd.block_size)[has_stale]
+        ssd.zone_life_time_ratio[:] = life_time_ratio.tolist()
+        utilization = zone_stats.getLiveSize() / zone_stats.max_space
+        score = (1 - utilization) * (1 + life_time_ratio) / (1 + utilization)
+        score[~has_stale] = 0
+        return int(numpy.argmax(score))
+
+
+class LifeTimePolicy(GreedyPolicy):
+    # Greedy victim selection, but live chunks are separated by life time: chunks with
+    # life_time >= age_threshold (cold) and younger chunks (hot) are each appended to
+    # their own destination zone, which is switched to an empty zone once it is full.
+    def __init__(self, age_threshold=1):
+        self.age_threshold = age_threshold
+        self.dst_zone_ids = {'hot': -1, 'cold': -1}
+
+    def selectDestination(self, fs, file_chunk, victim_zone_id):
+        ssd = fs.ssd
+        group = 'cold' if file_chunk.life_time >= self.age_threshold else 'hot'
+        other_group = 'hot' if group == 'cold' else 'cold'
+        zone_id = self.dst_zone_ids[group]
+        if zone_id > -1 and zone_id != victim_zone_id \
+                and ssd.peekZone(zone_id).remain_space >= file_chunk.size:
+            return zone_id
+
+        exclude_zone_ids = (victim_zone_id, self.dst_zone_ids[other_group])
+        zone_id = ssd.findEmptyZone(exclude_zone_ids)
+        if zone_id == -1:
+            zone_id = ssd.findFreeZone(file_chunk.size, exclude_zone_ids)
+        if zone_id == -1:
+            zone_id = ssd.findFreeZone(file_chunk.size, (victim_zone_id,))
+        if zone_id > -1:
+            self.dst_zone_ids[group] = zone_id
+        return zone_id
+
+# Snapshot file: a header, then raw little-endian arrays, each padded to 8 bytes
+#   ChunkTable columns (num_of_rows each), free_handles
+#   files: (inode, size, data_written, status, next_chunk_id, num_of_handles) each, then all
+#   their chunk handles
+#   zones: (write_pointer, first_free_block, remain_space, stale_size, live_chunks, birth_sum, state,
+#   rank in the open zones, rank in the active zones) each, zone_life_time_ratio
+#   allocated blocks, zone by zone: (remain_space, stale_size, live_chunks, birth_sum,
+#   num_of_handles) each, then all their chunk handles
+SNAPSHOT_MAGIC = b'ZNSSNAP\0'
+SNAPSHOT_VERSION = 6
+SNAPSHOT_HEADER = struct.Struct('<8sI4x3qdq5q6q4q')
+CHUNK_COLUMNS = (('inode', 'q'), ('birth', 'q'), ('chunk_id', 'i'), ('zone_id', 'i'),
+                 ('block_id', 'i'), ('size', 'i'), ('is_stale', 'b'), ('in_file', 'b'))
+FILE_STATUS = ('created', 'deleted')
+
+
+def writeSnapshotArray(f, values):
+    if sys.byteorder != 'little':
+        values = array(values.typecode, values)
+        values.byteswap()
+    data = values.tobytes()
+    f.write(data)
+    f.write(bytes(-len(data) % 8))
+
+
+def readSnapshotArray(data, offset, typecode, count):
+    values = array(typecode)
+    size = values.itemsize * count
+    values.frombytes(data[offset : offset + size])
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values, offset + size + (-size % 8)
+
+
+# List of Python values from a list, array or NumPy array
+def toList(values):
+    return values.tolist() if hasattr(values, 'tolist') else list(values)
+
+
+# Decorator of the ZnsFileSystem operations reporting their wall-clock cost to
+# zns_fs.metrics (see zns_metrics.py), and their simulated device time to the SSD's
+# TimingModel (see zns_timing.py). It costs two attribute checks when both are None.
+# Operations called by another operation are measured as part of it.
+def measureOperation(op):
+    def decorate(method):
+        @functools.wraps(method)
+        def measured(self, *args, **kwargs):
+            timing = self.ssd.timing
+            if timing is not None and not timing.in_operation:
+                timing.beginOperation()
+                try:
+                    return measured(self, *args, **kwargs)
+                finally:
+                    timing.endOperation(op)
+            metrics = self.metrics
+            if metrics is None or metrics.in_operation:
+                return method(self, *args, **kwargs)
+            metrics.in_operation = True
+            begin = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                metrics.in_operation = False
+                metrics.recordOperation(op, time.perf_counter() - begin)
+        return measured
+    return decorate
+
 
 class ZnsFileSystem:
 
-    def __init__(self, num_of_zones=32, num_of_blocks=32768, block_size=4096, verbose=False):
+    # check_consistency=True verifies every live space counter against the stored
+    # chunks after each operation. It is slow and only meant for tests.
+    # gc_policy is the GCPolicy used by garbageCollection(), GreedyPolicy by default.
+    # event_hook(event, *args) is called on every operation and error (see printEvent),
+    # verbose=True installs printEvent. Without a hook nothing is formatted or printed.
+    # Failed operations return the code of their ZnsError, or raise it if raise_errors.
+    # file_table maps inodes to files. Inodes are not reused, and a deleted file stays in
+    # the table until GC has erased all its chunks.
+    # device_id is the id of the SSD, e.g. its index in a ZnsArray (see zns_array.py).
+    # max_open_zones / max_active_zones are the zone limits of the SSD, 0 is unlimited.
+    # auto_gc_step > 0 turns on the automatic GC, see setAutoGC().
+    def __init__(self, num_of_zones=32, num_of_blocks=32768, block_size=4096, verbose=False,
+                 check_consistency=False, gc_policy=None, event_hook=None, raise_errors=False, device_id=0,
+                 max_open_zones=0, max_active_zones=0, auto_gc_step=0):
         self.verbose = verbose
+        self.event_hook = event_hook if event_hook is not None or not verbose else printEvent
+        self.raise_errors = raise_errors
+        self.error_count = 0
+        self.last_error = None
+        self.check_consistency = check_consistency
+        self.gc_policy = gc_policy if gc_policy is not None else GreedyPolicy()
         self.gc_threshold = 0
         self.gc_migrate_times = 0
         self.gc_migrate_size = 0
         self.gc_zone_reset_times = 0
+        # Live chunks GC failed to move, their victim zone was not reset
+        self.gc_move_failures = 0
+        self.auto_gc_step = auto_gc_step
+        # Victim of the incremental GC (-1 for none), its live chunks when it was
+        # selected and the position of the next one to migrate
+        self.gc_victim = -1
+        self.gc_pending = None
+        self.gc_pending_pos = 0
+        self.host_write_size = 0
+        self.metrics = None
         self.inode = 0
-        self.file_list = []
-        self.ssd = SSD(0, num_of_zones, num_of_blocks, block_size)
+        self.file_table = {}
+        self.ssd = SSD(device_id, num_of_zones, num_of_blocks, block_size, max_open_zones=max_open_zones,
+                       max_active_zones=max_active_zones)
 
+    @measureOperation('create')
     def createFile(self, size):
-        file = File(size, self.inode)
+        if self.auto_gc_step and size > self.ssd.remain_space:
+            self.collectForeground(size)
+        file = File(size, self.inode, self.ssd.chunk_table)
         data_written = self.ssd.writeFile(file)
         if (data_written == -1):
-            print("Error! Not enough space in SSD")
-            return -1
+            return self.fail(NotEnoughSpaceError(size, self.ssd.remain_space))
+        self.host_write_size += data_written
         if (data_written != file.size):
-            print("Error! Cannot write all data! ", data_written, "/", file.size)
-            return -2
+            return self.fail(PartialWriteError(data_written, file.size))
         
-        if (self.verbose):
-            print("File {} (size: {}) is created.".format(self.inode, size))
+        if self.event_hook is not None:
+            self.event_hook('create', self.inode, size)
 
-        self.file_list.append(file)
+        self.file_table[file.inode] = file
         self.inode += 1
+        self.autoGC()
+        self.checkConsistency()
         return file.inode
     
+    @measureOperation('create_on_zone')
     def createFileOnZone(self, size, zone_id):
-        file = File(0, self.inode)
+        file = File(0, self.inode, self.ssd.chunk_table)
         data_written = self.ssd.writeFileToZone(file, zone_id, size)
         if (data_written == -1):
-            print("Error! Not enough space in SSD")
-            return -1
-        if (self.verbose):
-            print("File {} (size: {}) is created on Zone {}.".format(self.inode, size, zone_id))
+            return self.fail(NotEnoughSpaceError(size, self.ssd.peekZone(zone_id).remain_space))
+        self.host_write_size += data_written
+        if self.event_hook is not None:
+            self.event_hook('create_on_zone', self.inode, size, zone_id)
 
-        self.file_list.append(file)
+        self.file_table[file.inode] = file
         self.inode += 1
+        self.autoGC()
+        self.checkConsistency()
         return file.inode
 
+    # Kept for compatibility, a view of file_table iterating the files
+    @property
+    def file_list(self):
+        return FileList(self.file_table)
+
+    # Files not deleted yet
+    def getLiveFiles(self):
+        for file in self.file_table.values():
+            if file.status != 'deleted':
+                yield file
+
+    @measureOperation('delete')
     def deleteFile(self, inode):
-        if inode >= len(self.file_list):
-            print('Error! Unknown file inode.')
-            return -2
-
-        file = self.file_list[inode]
-        file.status = 'deleted'
-        for chunk in file.chunk_list:
-            chunk.markStale()
-        
-        if (self.verbose):
-            print("File " + str(inode) + "'s chunks are marked stale.")
-        # TODO: don't pop now, we use inode as index sometimes
-        # self.file_list.pop(i)
+        if inode not in self.file_table:
+            return self.fail(UnknownFileError(inode))
+
+        self.removeFile(self.file_table[inode])
         self.updateLifeTime()
+        self.checkConsistency()
 
+    # Mark the chunks of the file stale, the file is reclaimed after GC erased them
+    def removeFile(self, file):
+        chunk_table = self.ssd.chunk_table
+        chunk_table.markStaleMany(file.chunk_map)
+        if file.status != 'deleted':
+            file.status = 'deleted'
+            zone_id = chunk_table.zone_id
+            chunk_table.addDeletedFile(file.inode, sum(1 for handle in file.chunk_map if zone_id[handle] >= 0))
+
+        if self.event_hook is not None:
+            self.event_hook('delete', file.inode)
+        self.reclaimFiles()
+
+    @measureOperation('delete_chunks')
     def deleteFileChunks(self, inode, beg_id, end_id):
-        if inode >= len(self.file_list):
-            print('Error! Unknown file inode.')
-            return -2
+        if inode not in self.file_table:
+            return self.fail(UnknownFileError(inode))
         
-        file = self.file_list[inode]
+        file = self.file_table[inode]
+        chunk_table = self.ssd.chunk_table
         #print('deleteFileChunks: File {}, Chunks:{}'.format(inode, len(file.chunk_list)))
-        for i in range(beg_id, end_id):
-            #print('deleteFileChunks() ', i)
-            file.chunk_list[i].markStale()
-            file.size -= file.chunk_list[i].size
-        del file.chunk_list[beg_id : end_id]
+        handles = file.chunk_map[beg_id : end_id]
+        chunk_table.markStaleMany(handles)
+        for handle in handles:
+            file.size -= chunk_table.size[handle]
+        file.deleteChunks(beg_id, end_id)
         file.data_written = file.size
+        self.reclaimFiles()
+        self.checkConsistency()
             
+    @measureOperation('append')
     def appendFile(self, inode, data_size):
-        if inode >= len(self.file_list):
-            print('Error! Unknown file inode.')
-            return -2
+        file = self.file_table.get(inode)
+        if file is None or file.status == 'deleted':
+            return self.fail(UnknownFileError(inode))
+        if self.auto_gc_step and data_size > self.ssd.remain_space:
+            self.collectForeground(data_size)
         if data_size > self.ssd.remain_space:
-            print('Error! Not enough space in SSD.')
-            return -1
-        file = self.file_list[inode]
+            return self.fail(NotEnoughSpaceError(data_size, self.ssd.remain_space))
         ret = self.ssd.appendFile(file, data_size)
+        self.host_write_size += ret
         
-        if (self.verbose):
-            print("Data {} have been appended to File {}.".format(data_size, file.inode))
+        if self.event_hook is not None:
+            self.event_hook('append', file.inode, data_size)
+        self.autoGC()
+        self.checkConsistency()
         return ret
     
+    # Overwrite size bytes of the file from the logical byte offset. The chunks holding
+    # the range are rewritten out of place with their id and size, so the file keeps its
+    # size and chunk order. Returns the number of bytes written.
+    @measureOperation('overwrite')
+    def overwriteFile(self, inode, offset, size):
+        file = self.file_table.get(inode)
+        if file is None or file.status == 'deleted':
+            return self.fail(UnknownFileError(inode))
+        chunk_map = file.chunk_map
+        chunk_table = self.ssd.chunk_table
+        beg = chunk_map.findOffset(offset)
+        handles = chunk_map[beg : chunk_map.findOffset(offset + size - 1) + 1 if size > 0 else beg]
+        if not handles:
+            return 0
+        data_size = sum(chunk_table.size[handle] for handle in handles)
+        if self.auto_gc_step and data_size > self.ssd.remain_space:
+            self.collectForeground(data_size)
+            handles = chunk_map[beg : beg + len(handles)] # GC moved chunks of the file
+        if data_size > self.ssd.remain_space:
+            return self.fail(NotEnoughSpaceError(data_size, self.ssd.remain_space))
+        # The new data is born at the next tick, the clock ticks once some is written
+        birth = chunk_table.clock.now + 1
+        data_written = 0
+        error = None
+        for handle in handles:
+            chunk_size = chunk_table.size[handle]
+            zone_id = self.ssd.findFreeZone(chunk_size)
+            if zone_id == -1:
+                error = NotEnoughSpaceError(chunk_size, self.ssd.remain_space)
+                break
+            if not self.relocateChunk(handle, zone_id, append=True, birth=birth):
+                error = self.getMoveError(handle, zone_id)
+                break
+            data_written += chunk_size
+        self.host_write_size += data_written
+        if data_written:
+            self.updateLifeTime()
+        if error is not None:
+            # The chunks rewritten before the failure keep their new data
+            self.checkConsistency()
+            return self.fail(error)
+
+        if self.event_hook is not None:
+            self.event_hook('overwrite', inode, offset, size)
+        self.autoGC()
+        self.checkConsistency()
+        return data_written
+
     # Our updateFile() is to delete some file junks first, and append new data
+    @measureOperation('update')
     def updateFile(self, inode, del_beg_id, del_end_id, new_data_size):
-        self.deleteFileChunks(inode, del_beg_id, del_end_id)
-        #print("Filesize after deleteFileChunks", self.file_list[inode].size)
+        ret = self.deleteFileChunks(inode, del_beg_id, del_end_id)
+        if ret is not None:
+            return ret
         self.updateLifeTime() # All other files alive life plus 1
-        if self.appendFile(inode, new_data_size) == -1:
-            print("Error! Not enough space. Failed to appendFile() in updateFile()!")
+        return self.appendFile(inode, new_data_size)
+
+    # Batch operations: the same results, errors and events as calling the operation on
+    # every item in turn. The items are lists or NumPy arrays of the same length, the
+    # result is the list of the items' return values. createFiles() and appendFiles()
+    # write the items one by one, the automatic GC running after each write as usual,
+    # but the batch is measured as one operation and checked for consistency once.
+    # deleteFiles() marks the chunks of all the files stale in one pass, reclaims the
+    # files and ticks the clock once.
+    @measureOperation('create_batch')
+    def createFiles(self, sizes):
+        return self.runBatch(self.createFile, sizes)
+
+    @measureOperation('append_batch')
+    def appendFiles(self, inodes, data_sizes):
+        return self.runBatch(self.appendFile, inodes, data_sizes)
+
+    @measureOperation('delete_batch')
+    def deleteFiles(self, inodes):
+        chunk_table = self.ssd.chunk_table
+        zone_id = chunk_table.zone_id
+        results = []
+        files = []
+        # Files without stored chunks, which deleteFile() reclaims at once
+        reclaimed = set()
+        try:
+            for inode in toList(inodes):
+                file = self.file_table.get(inode)
+                if file is None or inode in reclaimed:
+                    results.append(self.fail(UnknownFileError(inode)))
+                    continue
+                files.append(file)
+                results.append(None)
+                if file.status != 'deleted':
+                    file.status = 'deleted'
+                    num_of_chunks = sum(1 for handle in file.chunk_map if zone_id[handle] >= 0)
+                    chunk_table.addDeletedFile(inode, num_of_chunks)
+                    if not num_of_chunks:
+                        reclaimed.add(inode)
+                if self.event_hook is not None:
+                    self.event_hook('delete', inode)
+        finally:
+            # The files deleted before an error are, as by deleteFile()
+            chunk_table.markStaleMany([handle for file in files for handle in file.chunk_map])
+            self.reclaimFiles()
+            self.updateLifeTime(len(files))
+        self.checkConsistency()
+        return results
+
+    def runBatch(self, operation, *items):
+        items = [toList(values) for values in items]
+        if len({len(values) for values in items}) > 1:
+            raise ValueError('Batch items of different lengths: {}'.format([len(values) for values in items]))
+        check_consistency = self.check_consistency
+        self.check_consistency = False
+        try:
+            results = [operation(*args) for args in zip(*items)]
+        finally:
+            self.check_consistency = check_consistency
+        self.checkConsistency()
+        return results
 
     def printDataWritten(self):
-        for file in self.file_list:
+        for file in self.getLiveFiles():
             print('File {} => Size / DataWritten = {} / {}'.format(file.inode, file.size, file.data_written))
 
     def setGCThreshold(self, threshold):
         self.gc_threshold = threshold
 
+    # Automatic GC: while gc_policy.needGC() (i.e. above gc_threshold), every host
+    # write migrates about step_size bytes of the current victim, see stepGC(). A write
+    # that doesn't fit runs foreground GC first. step_size 0 turns it off.
+    def setAutoGC(self, step_size):
+        self.auto_gc_step = step_size
+
+    # Close an open zone, which frees an open slot. Returns False if it is not open.
+    def closeZone(self, zone_id):
+        if not self.ssd.closeZone(zone_id):
+            return False
+        if self.event_hook is not None:
+            self.event_hook('close', zone_id)
+        return True
+
+    # Make a zone full, its remaining space is lost until GC resets it. Returns False
+    # if it is already full.
+    def finishZone(self, zone_id):
+        if not self.ssd.finishZone(zone_id):
+            return False
+        if self.event_hook is not None:
+            self.event_hook('finish', zone_id)
+        self.checkConsistency()
+        return True
+
+    @measureOperation('move')
     def moveOneChunk(self, file_chunk, src_zone_id, dst_zone_id):
-        # Create a new FileChunk, and call Zone.writeChunk() to search a LogiDataUnit to save it
-        new_chunk = FileChunk(file_chunk.inode, None, file_chunk.id, file_chunk.size, file_chunk.life_time)
-        if self.ssd.group_list[dst_zone_id].writeChunk(new_chunk) == True:
-            self.file_list[file_chunk.inode].updateChunk(new_chunk)
-            self.ssd.remain_space -= new_chunk.size    
-            file_chunk.markStale()
-        else:
-            print('Error! Cannot move chunk(id:{}, size:{}) from Zone {} to Zone {}'
-                  .format(file_chunk.id, file_chunk.size, file_chunk.logi_unit.zone_id, dst_zone_id))
-        
+        # Create a new FileChunk, and call Zone.writeChunk() to search a block to save it
+        if not self.relocateChunk(file_chunk.handle, dst_zone_id):
+            return self.fail(self.getMoveError(file_chunk.handle, dst_zone_id))
+        self.checkConsistency()
+
+    # The moved chunk keeps its birth epoch, so its life time carries over, unless it
+    # is rewritten with new data born at birth. Returns False if the chunk can't be
+    # written to the zone, the caller reports it.
+    def relocateChunk(self, handle, dst_zone_id, append=False, birth=None):
+        chunk_table = self.ssd.chunk_table
+        inode = chunk_table.inode[handle]
+        new_handle = chunk_table.newChunk(inode, chunk_table.chunk_id[handle], chunk_table.size[handle],
+                                          chunk_table.birth[handle] if birth is None else birth)
+        if self.ssd.writeChunkToZone(new_handle, dst_zone_id, append) == True:
+            self.file_table[inode].replaceChunk(handle, new_handle)
+            chunk_table.markStale(handle)
+            return True
+        chunk_table.freeChunk(new_handle)
+        return False
+
+    def getMoveError(self, handle, dst_zone_id):
+        chunk_table = self.ssd.chunk_table
+        return ChunkMoveError(chunk_table.inode[handle], chunk_table.chunk_id[handle], chunk_table.size[handle],
+                              chunk_table.zone_id[handle], dst_zone_id)
+
+    # Move the live chunks (handles) out of a zone in one pass. Chunks are appended to
+    # the destination zones at their write pointer, and swapped into their files by
+    # chunk id. Stops at the first chunk that can't be moved, returns True if all of
+    # them were moved.
+    def migrateZone(self, zone_id, gc_policy, handles):
+        for handle in handles:
+            if not self.migrateChunk(handle, zone_id, gc_policy):
+                return False
+        return True
+
+    # Move a live chunk out of the victim zone, return the migrated size. A chunk that
+    # can't be moved is not a host error: it is counted in gc_move_failures and
+    # reported as a 'gc_move_failed' event, and 0 is returned.
+    def migrateChunk(self, handle, zone_id, gc_policy):
+        # Find a new space to copy the chunk
+        file_chunk = FileChunk(self.ssd.chunk_table, handle)
+        dst_zone_id = gc_policy.selectDestination(self, file_chunk, zone_id)
+        if dst_zone_id != -1:
+            if self.ssd.timing is not None:
+                self.ssd.timing.read(zone_id, file_chunk.size)
+            if not self.relocateChunk(handle, dst_zone_id, append=True):
+                dst_zone_id = -1
+        if dst_zone_id == -1:
+            self.gc_move_failures += 1
+            if self.event_hook is not None:
+                self.event_hook('gc_move_failed', file_chunk.inode, file_chunk.id, zone_id)
+            return 0
+        self.gc_migrate_times += 1
+        self.gc_migrate_size += file_chunk.size
+        if self.event_hook is not None:
+            self.event_hook('move', file_chunk.inode, file_chunk.id, zone_id, dst_zone_id)
+        return file_chunk.size
+
+    # Whether the live chunks (handles) of the victim zone fit in the rest of the SSD
+    def canMigrate(self, zone_id, handles):
+        ssd = self.ssd
+        size = ssd.chunk_table.size
+        return sum(size[handle] for handle in handles) <= ssd.remain_space - ssd.peekZone(zone_id).remain_space
+
+    # Live chunks of a zone in their order in the zone
+    def getLiveChunks(self, zone_id):
+        is_stale = self.ssd.chunk_table.is_stale
+        return array('q', (handle for handle in self.ssd.group_list[zone_id].getChunkHandles()
+                           if not is_stale[handle]))
+
+    def resetVictim(self, zone_id):
+        self.ssd.resetZone(zone_id)
+        self.reclaimFiles()
+        self.gc_zone_reset_times += 1
+        if self.event_hook is not None:
+            self.event_hook('reset', zone_id)
+
+    # Record a failed operation and return its legacy code, or raise it
+    def fail(self, error):
+        self.error_count += 1
+        self.last_error = error
+        if self.event_hook is not None:
+            self.event_hook('error', error)
+        if self.raise_errors:
+            raise error
+        return error.code
+
+    # Save the complete simulator state, except the GC policy and the event hook.
+    # The ChunkTable is stored column by column, so the file can be memory mapped.
+    def saveSnapshot(self, path):
+        ssd = self.ssd
+        chunk_table = ssd.chunk_table
+        file_meta = array('q')
+        file_handles = array('q')
+        for file in self.file_table.values():
+            file_meta.extend((file.inode, file.size, file.data_written, FILE_STATUS.index(file.status),
+                              file.next_chunk_id, len(file.chunk_map)))
+            file_handles.extend(file.chunk_map.toArray())
+        zone_meta = array('q')
+        block_meta = array('q')
+        block_handles = array('q')
+        open_ranks = {zone_id: rank for rank, zone_id in enumerate(ssd.open_zones)}
+        active_ranks = {zone_id: rank for rank, zone_id in enumerate(ssd.active_zones)}
+        for zone in ssd.group_list:
+            zone_meta.extend((zone.write_pointer, zone.first_free_block, zone.remain_space, zone.stale_size,
+                              zone.live_chunks, zone.birth_sum, ZONE_STATES.index(zone.state),
+                              open_ranks.get(zone.id, -1), active_ranks.get(zone.id, -1)))
+            handles = zone.getChunkHandles()
+            num_of_handles = [0] * zone.write_pointer
+            for handle in handles:
+                num_of_handles[chunk_table.block_id[handle]] += 1
+            for values in zip(zone.block_remain_space, zone.block_stale_size, zone.block_live_chunks,
+                              zone.block_birth_sum, num_of_handles):
+                block_meta.extend(values)
+            block_handles.extend(handles)
+
+        with open(path, 'wb') as f:
+            f.write(SNAPSHOT_HEADER.pack(
+                SNAPSHOT_MAGIC, SNAPSHOT_VERSION, ssd.num_of_zones, ssd.num_of_blocks, ssd.block_size,
+                self.gc_threshold, self.inode, self.gc_migrate_times, self.gc_migrate_size,
+                self.gc_zone_reset_times, self.host_write_size, chunk_table.clock.now, len(chunk_table.inode),
+                len(chunk_table.free_handles), len(self.file_table), len(file_handles), len(block_meta) // 5,
+                len(block_handles), ssd.max_open_zones, ssd.max_active_zones, self.gc_victim, self.gc_move_failures))
+            for column, typecode in CHUNK_COLUMNS:
+                writeSnapshotArray(f, getattr(chunk_table, column))
+            for values in (chunk_table.free_handles, file_meta, file_handles, zone_meta,
+                           array('d', ssd.zone_life_time_ratio), block_meta, block_handles):
+                writeSnapshotArray(f, values)
+
+    # Create a ZnsFileSystem from a snapshot. kwargs are passed to the constructor
+    # (verbose, gc_policy, ...), the geometry and the zone limits come from the snapshot.
+    @classmethod
+    def loadSnapshot(cls, path, **kwargs):
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return cls.loadSnapshotData(data, **kwargs)
+
+    @classmethod
+    def loadSnapshotData(cls, data, **kwargs):
+        (magic, version, num_of_zones, num_of_blocks, block_size, gc_threshold, inode, gc_migrate_times,
+         gc_migrate_size, gc_zone_reset_times, host_write_size, now, num_of_rows, num_of_free, num_of_files,
+         num_of_file_handles, num_of_written_blocks, num_of_block_handles, max_open_zones, max_active_zones,
+         gc_victim, gc_move_failures) = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('Not a ZNS simulator snapshot')
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version {}'.format(version))
+
+        zns_fs = cls(num_of_zones, num_of_blocks, block_size, max_open_zones=max_open_zones,
+                     max_active_zones=max_active_zones, **kwargs)
+        zns_fs.gc_threshold = gc_threshold
+        zns_fs.inode = inode
+        zns_fs.gc_migrate_times = gc_migrate_times
+        zns_fs.gc_migrate_size = gc_migrate_size
+        zns_fs.gc_zone_reset_times = gc_zone_reset_times
+        zns_fs.gc_move_failures = gc_move_failures
+        zns_fs.host_write_size = host_write_size
+        ssd = zns_fs.ssd
+        chunk_table = ssd.chunk_table
+        chunk_table.clock.now = now
+
+        offset = SNAPSHOT_HEADER.size
+        for column, typecode in CHUNK_COLUMNS:
+            values, offset = readSnapshotArray(data, offset, typecode, num_of_rows)
+            setattr(chunk_table, column, values)
+        chunk_table.free_handles, offset = readSnapshotArray(data, offset, 'q', num_of_free)
+        file_meta, offset = readSnapshotArray(data, offset, 'q', 6 * num_of_files)
+        file_handles, offset = readSnapshotArray(data, offset, 'q', num_of_file_handles)
+        zone_meta, offset = readSnapshotArray(data, offset, 'q', 9 * num_of_zones)
+        zone_life_time_ratio, offset = readSnapshotArray(data, offset, 'd', num_of_zones)
+        block_meta, offset = readSnapshotArray(data, offset, 'q', 5 * num_of_written_blocks)
+        block_handles, offset = readSnapshotArray(data, offset, 'q', num_of_block_handles)
+
+        handle_pos = 0
+        for i in range(num_of_files):
+            file_inode, size, data_written, status, next_chunk_id, num_of_handles = file_meta[6 * i : 6 * i + 6]
+            file = File(size, file_inode, chunk_table)
+            file.data_written = data_written
+            file.status = FILE_STATUS[status]
+            file.next_chunk_id = next_chunk_id
+            file.chunk_map = ChunkMap(chunk_table, file_handles[handle_pos : handle_pos + num_of_handles])
+            handle_pos += num_of_handles
+            zns_fs.file_table[file_inode] = file
+            if file.status == 'deleted':
+                chunk_table.addDeletedFile(file_inode, sum(1 for handle in file.chunk_map
+                                                           if chunk_table.zone_id[handle] >= 0))
+
+        block_pos = 0
+        handle_pos = 0
+        open_ranks = {}
+        active_ranks = {}
+        for zone in ssd.group_list:
+            (write_pointer, zone.first_free_block, zone.remain_space, zone.stale_size, zone.live_chunks,
+             zone.birth_sum, state, open_rank, active_rank) = zone_meta[9 * zone.id : 9 * zone.id + 9]
+            zone.state = ZONE_STATES[state]
+            if open_rank >= 0:
+                open_ranks[open_rank] = zone.id
+            if active_rank >= 0:
+                active_ranks[active_rank] = zone.id
+            meta = block_meta[5 * block_pos : 5 * (block_pos + write_pointer)]
+            for i, (column, typecode) in enumerate(Zone.columns[:4]):
+                setattr(zone, column, array(typecode, meta[i::5]))
+            num_of_handles = sum(meta[4::5])
+            zone.file_chunk_list = block_handles[handle_pos : handle_pos + num_of_handles]
+            zone.write_pointer = write_pointer
+            block_pos += write_pointer
+            handle_pos += num_of_handles
+            ssd.zone_life_time_ratio[zone.id] = zone_life_time_ratio[zone.id]
+        ssd.remain_space = sum(zone.remain_space for zone in ssd.group_list)
+        ssd.stale_size = sum(zone.stale_size for zone in ssd.group_list)
+        ssd.live_chunks = sum(zone.live_chunks for zone in ssd.group_list)
+        ssd.birth_sum = sum(zone.birth_sum for zone in ssd.group_list)
+        ssd.open_zones = dict.fromkeys(open_ranks[rank] for rank in sorted(open_ranks))
+        ssd.active_zones = dict.fromkeys(active_ranks[rank] for rank in sorted(active_ranks))
+        ssd.first_free_zone = 0
+        ssd.updateFirstFreeZone()
+        ssd.dirty_zones.update(range(num_of_zones))
+        zns_fs.reclaimFiles()
+        if gc_victim != -1:
+            # The chunks already migrated are stale
+            zns_fs.gc_victim = gc_victim
+            zns_fs.gc_pending = zns_fs.getLiveChunks(gc_victim)
+        zns_fs.checkConsistency()
+        return zns_fs
+
+    # Branch the file system, e.g. to compare GC policies from the same state. The fork
+    # shares all zones and files with this file system, and each of them copies a zone
+    # or file on first access. Objects taken from file_table or the SSD before the fork
+    # are not updated anymore. kwargs override the settings of the fork (gc_policy,
+    # verbose, ...), the GC policy is copied by default.
+    def fork(self, **kwargs):
+        zns_fs = ZnsFileSystem.__new__(ZnsFileSystem)
+        zns_fs.__dict__.update(self.__dict__)
+        zns_fs.gc_policy = copy.deepcopy(self.gc_policy)
+        zns_fs.metrics = None
+        zns_fs.error_count = 0
+        zns_fs.last_error = None
+        for name, value in kwargs.items():
+            if name == 'verbose' and 'event_hook' not in kwargs:
+                zns_fs.event_hook = printEvent if value else None
+            setattr(zns_fs, name, value)
+        zns_fs.ssd = self.ssd.fork()
+        files = dict.copy(self.file_table)
+        for fork in (self, zns_fs):
+            fork.file_table = CowDict(fork.ssd, files, fork.copyFile)
+        return zns_fs
+
+    def copyFile(self, file):
+        return file.copy(self.ssd.chunk_table)
+
+    # Remove the deleted files whose chunks have all been erased, and free their rows
+    def reclaimFiles(self):
+        chunk_table = self.ssd.chunk_table
+        while chunk_table.reclaimable_files:
+            file = dict.pop(self.file_table, chunk_table.reclaimable_files.pop())
+            for handle in file.chunk_map:
+                chunk_table.freeChunk(handle)
+
+    def setEventHook(self, event_hook):
+        self.event_hook = event_hook
+
+    def setGCPolicy(self, gc_policy):
+        self.gc_policy = gc_policy
+
     def gcStaleGreedy(self):
-        # Trigger GC when total data size exceeds GC threshold
-        if (self.ssd.max_space - self.ssd.remain_space) / self.ssd.max_space <= self.gc_threshold:
+        return self.runGC(GreedyPolicy())
+
+    @measureOperation('gc')
+    def runGC(self, gc_policy):
+        if self.gc_victim != -1:
+            # Complete the victim of the incremental GC first
+            self.stepGC(gc_policy, 0)
+            self.checkConsistency()
+            return 1
+        if not gc_policy.needGC(self):
             return 0
-            
-        # Find the zone with max stale FileChunk size
-        max_stale = 0
-        zone_id = -1
-        zone_list = self.ssd.group_list
-        for i, zone in enumerate(zone_list):
-            stale_size = zone.getStaleSize()
-            if max_stale < stale_size:
-                max_stale = stale_size
-                zone_id = i
+
+        zone_id = gc_policy.selectVictim(self)
 
         if zone_id > -1:
-            # Copy chunks
-            zone_file_chunk_list = []
-            zone_list[zone_id].getFileChunkList(zone_file_chunk_list)
-            for file_chunk in zone_file_chunk_list:
-                if file_chunk.is_stale:
-                    continue
+            # Like stepGC(), a victim whose live chunks can't all be moved is given up
+            # instead of reset, so no live data is lost
+            handles = self.getLiveChunks(zone_id)
+            if not self.canMigrate(zone_id, handles) or not self.migrateZone(zone_id, gc_policy, handles):
+                self.checkConsistency()
+                return 0
+            self.resetVictim(zone_id)
 
-                # Find a new space to copy the chunk
-                for i, zone in enumerate(zone_list):
-                    if i == zone_id:
-                        continue
-
-                    if file_chunk.size <= zone.remain_space:
-                        self.moveOneChunk(file_chunk, src_zone_id=zone_id, dst_zone_id=zone.id)
-                        self.gc_migrate_times += 1
-                        self.gc_migrate_size += file_chunk.size
-                        if (self.verbose):
-                            print("Chunk (", file_chunk.inode, ",", file_chunk.id, ") in zone ", zone_id, " is moved to zone " + str(i))
-                        break
-
-            self.ssd.group_list[zone_id].resetState()
-            self.ssd.updateRemainSpace()
-            self.gc_zone_reset_times += 1
-            if (self.verbose):
-                print("Zone " + str(zone_id) + " is reset.")
-
-        if (self.verbose):
-            print("Garbage collection done.")
-        
+        if self.event_hook is not None:
+            self.event_hook('gc_done')
+
+        self.checkConsistency()
+        return 1
+
+    # One step of the incremental GC. Without a victim in progress, it selects one if
+    # GC is needed (or force) and its live chunks fit in the rest of the SSD, and
+    # finishes it, so that host writes don't go to it. Then it migrates the victim's
+    # live chunks until step_size bytes are moved (all of them if step_size is 0), and
+    # resets the victim after the last one. The progress is kept in gc_victim,
+    # gc_pending and gc_pending_pos across steps. A victim whose chunk can't be moved,
+    # or whose move raises, is given up instead of reset, so no live data is lost.
+    # Returns 1 if a victim was reset.
+    def stepGC(self, gc_policy, step_size, force=False):
+        ssd = self.ssd
+        chunk_table = ssd.chunk_table
+        if self.gc_victim == -1:
+            if not force and not gc_policy.needGC(self):
+                return 0
+            zone_id = gc_policy.selectVictim(self)
+            if zone_id == -1:
+                return 0
+            pending = self.getLiveChunks(zone_id)
+            if not self.canMigrate(zone_id, pending):
+                return 0
+            ssd.finishZone(zone_id)
+            self.gc_victim = zone_id
+            self.gc_pending = pending
+            self.gc_pending_pos = 0
+
+        zone_id = self.gc_victim
+        is_stale = chunk_table.is_stale
+        pending = self.gc_pending
+        migrated = 0
+        moved = True
+        while self.gc_pending_pos < len(pending) and (not step_size or migrated < step_size):
+            handle = pending[self.gc_pending_pos]
+            # Chunks deleted or overwritten since the victim was selected are skipped
+            if not is_stale[handle]:
+                try:
+                    size = self.migrateChunk(handle, zone_id, gc_policy)
+                except BaseException:
+                    self.dropVictim()
+                    raise
+                if not size:
+                    moved = False
+                    break
+                migrated += size
+            self.gc_pending_pos += 1
+        if moved and self.gc_pending_pos < len(pending):
+            return 0
+
+        self.dropVictim()
+        if not moved:
+            return 0
+        self.resetVictim(zone_id)
+        if self.event_hook is not None:
+            self.event_hook('gc_done')
         return 1
 
+    # End the incremental GC of the victim, without resetting it
+    def dropVictim(self):
+        self.gc_victim = -1
+        self.gc_pending = None
+        self.gc_pending_pos = 0
+
+    # Incremental GC step after a host write, see setAutoGC()
+    def autoGC(self):
+        if self.auto_gc_step:
+            timing = self.ssd.timing
+            if timing is None:
+                self.stepGC(self.gc_policy, self.auto_gc_step)
+                return
+            # The host doesn't wait for the background GC work
+            timing.background = True
+            try:
+                self.stepGC(self.gc_policy, self.auto_gc_step)
+            finally:
+                timing.background = False
+
+    # Foreground GC before failing a write of size bytes: complete the current victim,
+    # then collect more zones until the write fits or GC frees no more space
+    def collectForeground(self, size):
+        ssd = self.ssd
+        while ssd.remain_space < size:
+            remain_space = ssd.remain_space
+            in_progress = self.gc_victim != -1
+            if not self.stepGC(self.gc_policy, 0, force=True):
+                break
+            if not in_progress and ssd.remain_space <= remain_space:
+                break
+
     def garbageCollection(self):
-        self.gcStaleGreedy()
+        return self.runGC(self.gc_policy)
 
-    def updateLifeTime(self):
-        for file in self.file_list:
-            if file.status == 'deleted':
-                continue
-            for chunk in file.chunk_list:
-                chunk.life_time += 1
+    # All live chunks (deleted files' chunks are stale) get ticks units older
+    def updateLifeTime(self, ticks=1):
+        self.ssd.clock.tick(ticks)
+
+    def checkConsistency(self):
+        if self.check_consistency:
+            self.ssd.verifyCounters()
 
     def printFileChunks(self):
-        for file in self.file_list:
+        for file in self.file_table.values():
             for chunk in file.chunk_list:
                 chunk.print()
 
@@ -450,3 +2467,4 @@ class ZnsFileSystem:
         print("Migration times:", self.gc_migrate_times)
         print("Migration data size:", self.gc_migrate_size)
         print("Zone reset times:", self.gc_zone_reset_times)
+        print("Failed migrations:", self.gc_move_failures)
@@ -0,0 +1,169 @@
+# Parallel parameter sweep for the ZNS File System simulator
+#
+# Every combination of geometry, GC threshold, GC policy and seed is simulated
+# in its own ZnsFileSystem on a process pool, all of them replaying the same
+# workload. The workload is a binary trace file, memory mapped read-only by the
+# workers, or a synthetic workload of zns_bench.py that is written once per seed
+# to a temporary binary trace. The GC stats of all runs are gathered in one table:
+#   python zns_sweep.py --workload zipf --ops 50000 --zones 8 16 --blocks 64 \
+#       --gc-thresholds 0 0.5 --policies greedy cost_benefit --output sweep.csv
+
+import argparse
+import csv
+import itertools
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from zns_bench import WORKLOADS
+from zns_replay import BINARY_MAGIC, BINARY_RECORD, OP_ARGS, OPS, TraceReplayer, readTrace, writeBinaryTrace
+from zns_sim import CostBenefitPolicy, GreedyPolicy, LifeTimePolicy, ZnsFileSystem
+
+GC_POLICIES = {
+    'greedy': GreedyPolicy,
+    'cost_benefit': CostBenefitPolicy,
+    'life_time': LifeTimePolicy,
+}
+
+CONFIG_COLUMNS = ('num_of_zones', 'num_of_blocks', 'block_size', 'gc_threshold', 'gc_policy', 'seed')
+STATS_COLUMNS = ('ops', 'errors', 'host_write_size', 'gc_migrate_times', 'gc_migrate_size',
+                 'gc_zone_reset_times', 'write_amplification', 'elapsed')
+
+
+def getSweepConfigs(geometries, gc_thresholds, gc_policies, seeds):
+    configs = []
+    for (num_of_zones, num_of_blocks, block_size), gc_threshold, gc_policy, seed in itertools.product(
+            geometries, gc_thresholds, gc_policies, seeds):
+        configs.append({
+            'num_of_zones': num_of_zones,
+            'num_of_blocks': num_of_blocks,
+            'block_size': block_size,
+            'gc_threshold': gc_threshold,
+            'gc_policy': gc_policy,
+            'seed': seed,
+        })
+    return configs
+
+
+# Read an uncompressed binary trace through a read-only memory map, so that
+# processes replaying the same trace share its pages
+def mapBinaryTrace(path):
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+                raise ValueError('Not a binary trace: {}'.format(path))
+            if (len(data) - len(BINARY_MAGIC)) % BINARY_RECORD.size:
+                raise ValueError('Truncated binary trace: {}'.format(path))
+            with memoryview(data) as view:
+                for record in BINARY_RECORD.iter_unpack(view[len(BINARY_MAGIC):]):
+                    op = OPS[record[0]]
+                    yield op, record[1 : 1 + len(OP_ARGS[op])]
+
+
+def readSweepTrace(path):
+    # Binary traces are shared through mmap, other formats are streamed by each worker
+    if path.endswith('.bin'):
+        return mapBinaryTrace(path)
+    return readTrace(path)
+
+
+# Simulate one configuration on its trace, return the config with its GC stats
+def runConfig(config):
+    zns_fs = ZnsFileSystem(num_of_zones=config['num_of_zones'], num_of_blocks=config['num_of_blocks'],
+                           block_size=config['block_size'], gc_policy=GC_POLICIES[config['gc_policy']]())
+    zns_fs.setGCThreshold(config['gc_threshold'])
+    replayer = TraceReplayer(zns_fs, config['gc_interval'], config['gc_free_ratio'])
+    begin = time.perf_counter()
+    stats = replayer.run(readSweepTrace(config['trace']))
+    stats['elapsed'] = time.perf_counter() - begin
+    row = {column: config[column] for column in CONFIG_COLUMNS}
+    row.update((column, stats[column]) for column in STATS_COLUMNS)
+    return row
+
+
+# Run all configs on trace, or on a synthetic workload generated with their seed.
+# The result rows are in the order of configs. processes=None uses all cores,
+# processes=1 runs in this process.
+def runSweep(configs, trace=None, workload=None, num_ops=0, gc_interval=0, gc_free_ratio=None,
+             processes=None):
+    if (trace is None) == (workload is None):
+        raise ValueError('Either a trace or a workload is needed')
+    with tempfile.TemporaryDirectory() as trace_dir:
+        tasks = []
+        traces = {}
+        for config in configs:
+            if trace is None:
+                seed = config['seed']
+                if seed not in traces:
+                    traces[seed] = os.path.join(trace_dir, 'trace-{}.bin'.format(seed))
+                    writeSweepWorkload(workload, num_ops, configs, seed, traces[seed])
+                config_trace = traces[seed]
+            else:
+                config_trace = trace
+            tasks.append(dict(config, trace=config_trace, gc_interval=gc_interval, gc_free_ratio=gc_free_ratio))
+
+        if processes == 1:
+            return [runConfig(task) for task in tasks]
+        with multiprocessing.Pool(processes) as pool:
+            chunksize = max(1, len(tasks) // (4 * (processes or os.cpu_count() or 1)))
+            return pool.map(runConfig, tasks, chunksize)
+
+
+# Synthetic traces are sized for the smallest SSD of the sweep, so that every
+# configuration replays exactly the same operations
+def writeSweepWorkload(workload, num_ops, configs, seed, path):
+    capacity = min(config['num_of_zones'] * config['num_of_blocks'] * config['block_size'] for config in configs)
+    block_size = min(config['block_size'] for config in configs)
+    writeBinaryTrace(WORKLOADS[workload].generate(num_ops, capacity, block_size, seed), path)
+
+
+def printTable(rows):
+    columns = CONFIG_COLUMNS + STATS_COLUMNS
+    cells = [[column for column in columns]]
+    for row in rows:
+        cells.append(['{:.3f}'.format(row[column]) if isinstance(row[column], float) else str(row[column])
+                      for column in columns])
+    widths = [max(len(line[i]) for line in cells) for i in range(len(columns))]
+    for line in cells:
+        print('  '.join(cell.rjust(width) for cell, width in zip(line, widths)))
+
+
+def writeCsv(rows, path):
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CONFIG_COLUMNS + STATS_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Sweep the ZNS simulator parameters over one workload')
+    workload_group = parser.add_mutually_exclusive_group(required=True)
+    workload_group.add_argument('--trace', help='trace file replayed by every configuration')
+    workload_group.add_argument('--workload', choices=sorted(WORKLOADS), help='synthetic workload of zns_bench.py')
+    parser.add_argument('--ops', type=int, default=20000, help='number of operations of the synthetic workload')
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0])
+    parser.add_argument('--zones', type=int, nargs='+', default=[32])
+    parser.add_argument('--blocks', type=int, nargs='+', default=[256])
+    parser.add_argument('--block-size', type=int, nargs='+', default=[4096])
+    parser.add_argument('--gc-thresholds', type=float, nargs='+', default=[0])
+    parser.add_argument('--policies', nargs='+', choices=sorted(GC_POLICIES), default=['greedy'])
+    parser.add_argument('--gc-interval', type=int, default=0)
+    parser.add_argument('--gc-free-ratio', type=float, default=0.1)
+    parser.add_argument('--processes', type=int, default=None, help='worker processes, all cores by default')
+    parser.add_argument('--output', help='save the result table to this CSV file')
+    args = parser.parse_args(argv)
+
+    geometries = list(itertools.product(args.zones, args.blocks, args.block_size))
+    configs = getSweepConfigs(geometries, args.gc_thresholds, args.policies, args.seeds)
+    rows = runSweep(configs, args.trace, args.workload, args.ops, args.gc_interval, args.gc_free_ratio,
+                    args.processes)
+    printTable(rows)
+    if args.output:
+        writeCsv(rows, args.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# Device timing model of the ZNS File System simulator
+#
+# A TimingModel attached to the SSD of a ZnsFileSystem gives the device work a
+# duration: programming bytes (host writes and GC copies), reading the chunks GC
+# migrates, and resetting zones. It runs a discrete-event clock next to the
+# simulator: every zone does one piece of work at a time, and at most
+# parallel_zones zones (the parallel units of the device) work at once. The host
+# issues the operations one after the other (queue depth 1) and waits for their
+# device work, so an operation writing to a zone busy with GC takes longer. The
+# automatic GC of the write path runs in the background: it keeps the zones busy,
+# but the host doesn't wait for it.
+#   timing = TimingModel(zns_fs, program_time=1e-8, reset_time=2e-3, interval=1000)
+#   ... run the workload ...
+#   timing.flush()
+#   print(timing.getStats())
+
+import csv
+import heapq
+import math
+from array import array
+
+from zns_metrics import OperationStats
+
+# Every `interval` operations, host_write_size is the amount of the interval, time
+# the simulated time at its end, throughput the host bytes per simulated second
+# of the interval, and the latencies those of its operations. Times are in seconds.
+SERIES = ('ops', 'time', 'host_write_size', 'throughput', 'latency_mean', 'latency_p50', 'latency_p99',
+          'latency_p999', 'latency_max')
+PERCENTILES = (('p50', 50), ('p99', 99), ('p999', 99.9))
+
+# Latencies of the whole run are counted in logarithmic buckets 1% apart, from 1 ns
+HISTOGRAM_MIN = 1e-9
+HISTOGRAM_SCALE = 100
+
+
+# Value at percent of the sorted values (nearest rank)
+def getPercentile(values, percent):
+    if not values:
+        return 0
+    return values[max(0, min(len(values) - 1, math.ceil(percent / 100 * len(values)) - 1))]
+
+
+class TimingModel:
+    # program_time / read_time: seconds per byte programmed / read, reset_time: seconds
+    # per zone reset, parallel_zones: number of zones working at once, 0 for all of them
+    def __init__(self, zns_fs, program_time=1e-8, read_time=2.5e-9, reset_time=2e-3, parallel_zones=0,
+                 interval=1000):
+        self.zns_fs = zns_fs
+        self.program_time = program_time
+        self.read_time = read_time
+        self.reset_time = reset_time
+        self.interval = interval
+        # Time each zone is done with its work, and heap of the times the parallel
+        # units are free
+        self.zone_free = [0.0] * zns_fs.ssd.num_of_zones
+        self.units = [0.0] * parallel_zones
+        # Host clock, and the start and end of the device work of the current operation
+        self.now = 0.0
+        self.op_start = 0.0
+        self.op_end = 0.0
+        # End of the read of the chunk GC is copying, the copy is programmed after it
+        self.copy_ready = None
+        self.in_operation = False
+        self.background = False
+        self.op_stats = OperationStats()
+        self.histogram = {}
+        self.first_host_write_size = zns_fs.host_write_size
+        self.series = {name: [] for name in SERIES}
+        self.resetInterval()
+        zns_fs.ssd.timing = self
+
+    def detach(self):
+        if self.zns_fs.ssd.timing is self:
+            self.zns_fs.ssd.timing = None
+
+    @property
+    def op_count(self):
+        return self.op_stats.count
+
+    def resetInterval(self):
+        self.interval_begin = self.now
+        self.latencies = array('d')
+        self.last_host_write_size = self.zns_fs.host_write_size
+
+    # Schedule duration seconds of work on the zone, issued at issue. Returns its end.
+    def schedule(self, zone_id, duration, issue):
+        start = max(issue, self.zone_free[zone_id])
+        units = self.units
+        if units:
+            start = max(start, units[0])
+            end = start + duration
+            heapq.heapreplace(units, end)
+        else:
+            end = start + duration
+        self.zone_free[zone_id] = end
+        if not self.background and end > self.op_end:
+            self.op_end = end
+        return end
+
+    # Called by the SSD
+    def program(self, zone_id, size):
+        issue = self.op_start
+        if self.copy_ready is not None:
+            issue = self.copy_ready
+            self.copy_ready = None
+        self.schedule(zone_id, size * self.program_time, issue)
+
+    def read(self, zone_id, size):
+        self.copy_ready = self.schedule(zone_id, size * self.read_time, self.op_start)
+
+    def reset(self, zone_id):
+        self.schedule(zone_id, self.reset_time, self.op_start)
+
+    # Called by ZnsFileSystem around every operation
+    def beginOperation(self):
+        self.in_operation = True
+        self.op_start = self.op_end = self.now
+
+    def endOperation(self, op):
+        self.in_operation = False
+        self.copy_ready = None
+        latency = self.op_end - self.op_start
+        self.now = self.op_end
+        self.op_stats.add(op, latency)
+        bucket = math.floor(math.log(latency / HISTOGRAM_MIN) * HISTOGRAM_SCALE) if latency > HISTOGRAM_MIN else -1
+        self.histogram[bucket] = self.histogram.get(bucket, 0) + 1
+        self.latencies.append(latency)
+        if len(self.latencies) >= self.interval:
+            self.sample()
+
+    def sample(self):
+        latencies = sorted(self.latencies)
+        elapsed = self.now - self.interval_begin
+        host_write_size = self.zns_fs.host_write_size - self.last_host_write_size
+        values = {
+            'ops': self.op_count,
+            'time': self.now,
+            'host_write_size': host_write_size,
+            'throughput': host_write_size / elapsed if elapsed else 0,
+            'latency_mean': sum(latencies) / len(latencies) if latencies else 0,
+            'latency_max': latencies[-1] if latencies else 0,
+        }
+        for name, percent in PERCENTILES:
+            values['latency_' + name] = getPercentile(latencies, percent)
+        for name in SERIES:
+            self.series[name].append(values[name])
+        self.resetInterval()
+
+    # Sample the operations since the last interval, if any. Every interval of
+    # the run is kept.
+    def flush(self):
+        if self.latencies:
+            self.sample()
+
+    def __len__(self):
+        return len(self.series['ops'])
+
+    def getSeries(self, name):
+        return self.series[name]
+
+    # Latency at percent of all operations since the start, rounded up to its bucket
+    def getLatencyPercentile(self, percent):
+        rank = max(1, math.ceil(percent / 100 * self.op_count))
+        count = 0
+        for bucket in sorted(self.histogram):
+            count += self.histogram[bucket]
+            if count >= rank:
+                if bucket < 0:
+                    return 0.0
+                return min(HISTOGRAM_MIN * math.exp((bucket + 1) / HISTOGRAM_SCALE), self.op_stats.max)
+        return 0.0
+
+    # Simulated latency stats of each operation: (count, mean, max) in seconds
+    def getOperationStats(self):
+        return self.op_stats.getStats()
+
+    # Simulated time, host throughput and latencies of the whole run
+    def getStats(self):
+        host_write_size = self.zns_fs.host_write_size - self.first_host_write_size
+        stats = {
+            'ops': self.op_count,
+            'time': self.now,
+            'host_write_size': host_write_size,
+            'throughput': host_write_size / self.now if self.now else 0,
+            'latency_mean': self.op_stats.getMean(),
+            'latency_max': self.op_stats.max,
+        }
+        for name, percent in PERCENTILES:
+            stats['latency_' + name] = self.getLatencyPercentile(percent)
+        return stats
+
+    def writeCsv(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(SERIES)
+            writer.writerows(zip(*(self.series[name] for name in SERIES)))